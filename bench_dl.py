@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""Benchmarks for dl.py against a local HTTP stand-in for an HLS origin"""
+import argparse
+import io
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import dl
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive between segments
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        # Named files first (playlists, keys); any other path is a stock segment
+        body = self.server.files.get(self.path.lstrip('/'), self.server.segment)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OriginServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping idle keep-alive connections on exit is expected
+        pass
+
+
+def start_origin(segment_size, files=None):
+    """Start the stand-in origin on a free local port and return it"""
+    server = OriginServer(('127.0.0.1', 0), OriginHandler)
+    server.segment = b'\x47' * segment_size
+    server.files = files or {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def unpooled_download_segment(segment_url, headers=None, policy=None, latency=None, byte_range=None,
+                              cancel=None):
+    # The pre-pooling behaviour: a fresh connection for every segment
+    try:
+        response = requests.get(segment_url, headers=headers, stream=True,
+                                timeout=(dl.CONNECT_TIMEOUT, dl.READ_TIMEOUT))
+        response.raise_for_status()
+        data = bytearray()
+        for chunk in response.iter_content(chunk_size=dl.CHUNK_SIZE):
+            data += chunk
+        return data
+    except Exception as e:
+        print(f"Error downloading {segment_url}: {e}")
+        return None
+
+
+def time_segments(base_url, count, fetch):
+    """Download count segments through dl.write_segments and return segments/sec"""
+    segment_urls = [f"{base_url}/segment_{i:05d}.ts" for i in range(count)]
+    fetches = [dl.Fetch(url, None, None, [dl.Part(i, url, None, None, None)])
+               for i, url in enumerate(segment_urls)]
+    original = dl.download_segment
+    dl.download_segment = fetch
+    try:
+        with ThreadPoolExecutor(max_workers=dl.MAX_WORKERS) as executor:
+            started = time.perf_counter()
+            dl.write_segments(executor, fetches, io.BytesIO())
+            elapsed = time.perf_counter() - started
+    finally:
+        dl.download_segment = original
+    print()
+    return count / elapsed
+
+
+def bench_pool(args):
+    server = start_origin(args.segment_size)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    try:
+        unpooled = time_segments(base_url, args.segments, unpooled_download_segment)
+        pooled = time_segments(base_url, args.segments, dl.download_segment)
+    finally:
+        server.shutdown()
+    print(f"{args.segments} segments of {args.segment_size} bytes, {dl.MAX_WORKERS} workers")
+    print(f"  new connection per segment: {unpooled:8.1f} segments/sec")
+    print(f"  pooled keep-alive sessions: {pooled:8.1f} segments/sec ({pooled / unpooled:.2f}x)")
+
+
+def encrypt_aes128(data, key, iv):
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    pad = 16 - len(data) % 16
+    encryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).encryptor()
+    return encryptor.update(data + bytes([pad]) * pad) + encryptor.finalize()
+
+
+def bench_aes(args):
+    # A METHOD=AES-128 playlist whose key is served by the same local origin,
+    # with IVs left implicit so dl.py has to derive them from the sequence
+    key = os.urandom(16)
+    plain = os.urandom(args.segment_size)
+    files = {'key.bin': key}
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:6',
+             '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-KEY:METHOD=AES-128,URI="key.bin"']
+    for i in range(args.segments):
+        files[f"segment_{i:05d}.ts"] = encrypt_aes128(plain, key, i.to_bytes(16, 'big'))
+        lines += ['#EXTINF:6.0,', f"segment_{i:05d}.ts"]
+    lines.append('#EXT-X-ENDLIST')
+    files['playlist.m3u8'] = '\n'.join(lines).encode()
+
+    server = start_origin(0, files)
+    total_mb = args.segments * args.segment_size / 1e6
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'out.ts')
+            started = time.perf_counter()
+            dl.download_hls_video(f"http://127.0.0.1:{server.server_port}/playlist.m3u8", output,
+                                  engine=args.engine)
+            elapsed = time.perf_counter() - started
+            with open(output, 'rb') as f:
+                for _ in range(args.segments):
+                    assert f.read(len(plain)) == plain, "decrypted output does not match"
+    finally:
+        server.shutdown()
+
+    ciphertext = files['segment_00000.ts']
+    started = time.perf_counter()
+    for i in range(args.segments):
+        dl.decrypt_aes128(ciphertext, key, (0).to_bytes(16, 'big'))
+    decrypt_only = time.perf_counter() - started
+
+    print(f"{args.segments} encrypted segments of {args.segment_size} bytes, {args.engine} engine")
+    print(f"  end to end:   {total_mb / elapsed:8.1f} MB/s")
+    print(f"  decrypt only: {total_mb / decrypt_only:8.1f} MB/s (one core)")
+
+
+def bench_rate(args):
+    # 127.0.0.1 and localhost reach the same origin but count as two hosts,
+    # which exercises the per-host buckets alongside the global one
+    server = start_origin(args.segment_size)
+    hosts = [f"127.0.0.1:{server.server_port}", f"localhost:{server.server_port}"]
+    segment_urls = [f"http://{hosts[i % 2]}/segment_{i:05d}.ts" for i in range(args.segments)]
+    fetches = [dl.Fetch(url, None, None, [dl.Part(i, url, None, None, None)])
+               for i, url in enumerate(segment_urls)]
+    policy = dl.FetchPolicy(hedge=False, limiter=dl.RateLimiter(args.rate, args.host_rate))
+    try:
+        with ThreadPoolExecutor(max_workers=dl.MAX_WORKERS) as executor:
+            started = time.perf_counter()
+            dl.write_segments(executor, fetches, io.BytesIO(), policy=policy)
+            elapsed = time.perf_counter() - started
+    finally:
+        server.shutdown()
+    print()
+
+    achieved = args.segments * args.segment_size / elapsed
+    print(f"{args.segments} segments of {args.segment_size} bytes over 2 hosts in {elapsed:.1f}s")
+    if args.rate:
+        print(f"  global cap {args.rate / 1e6:8.2f} MB/s, achieved {achieved / 1e6:8.2f} MB/s")
+    if args.host_rate:
+        print(f"  per-host cap {args.host_rate / 1e6:6.2f} MB/s, achieved {achieved / 2e6:8.2f} MB/s per host")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark dl.py against a local HTTP origin")
+    subparsers = parser.add_subparsers(dest='scenario', required=True)
+
+    pool = subparsers.add_parser('pool', help="Segments/sec with and without connection pooling")
+    pool.add_argument('--segments', type=int, default=2000)
+    pool.add_argument('--segment-size', type=int, default=64 * 1024)
+    pool.set_defaults(func=bench_pool)
+
+    aes = subparsers.add_parser('aes', help="MB/s through the AES-128 decryption pipeline")
+    aes.add_argument('--segments', type=int, default=500)
+    aes.add_argument('--segment-size', type=int, default=1024 * 1024)
+    aes.add_argument('--engine', choices=['threads', 'async'], default='threads')
+    aes.set_defaults(func=bench_aes)
+
+    rate = subparsers.add_parser('rate', help="Achieved vs configured rate under the token buckets")
+    rate.add_argument('--segments', type=int, default=200)
+    rate.add_argument('--segment-size', type=int, default=256 * 1024)
+    rate.add_argument('--rate', type=dl.parse_rate, default=dl.parse_rate('10M'))
+    rate.add_argument('--host-rate', type=dl.parse_rate)
+    rate.set_defaults(func=bench_rate)
+
+    args = parser.parse_args()
+    args.func(args)
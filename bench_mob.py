@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Benchmarks for MOB.py duplicate detection on synthetic documents"""
+import argparse
+import random
+import time
+
+from bson import encode
+from pymongo import MongoClient
+
+import MOB
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+
+received_bytes = 0
+
+
+def received(cursor):
+    """Pass results through, adding up their BSON size: what crosses the wire to us"""
+    global received_bytes
+    for document in cursor:
+        received_bytes += len(encode(document))
+        yield document
+
+
+def client_side_groups(collection):
+    # The pre-aggregation behaviour: every id and name of every size group
+    # comes back to be ranked here
+    pipeline = [
+        {"$group": {"_id": "$size", "ids": {"$push": "$_id"}, "names": {"$push": "$name"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+    keep = {}
+    for group in received(collection.aggregate(pipeline, allowDiskUse=True)):
+        ranked = sorted(zip(group['names'], group['ids']), key=lambda x: MOB.quality_rank(x[0]))
+        keep[group['_id']] = (ranked[0][1], group['count'], {doc_id: name for name, doc_id in ranked})
+    return keep
+
+
+def server_side_groups(collection):
+    return {group['_id']: (group['keep'], group['count']) for group in received(MOB.duplicate_groups(collection))}
+
+
+def seed(collection, docs, duplicate_share):
+    """Insert docs files, duplicate_share of them sharing a size with another"""
+    collection.drop()
+    tags = MOB.preferred_order + ['WEBRip', 'HDTV']
+    sizes = int(docs * (1 - duplicate_share)) or 1
+    batch = []
+    for i in range(docs):
+        size = i if i < sizes else random.randrange(sizes)
+        batch.append({'size': size * 1024 + 7, 'name': f"Movie {size} ({random.choice(tags)}) [{i}].mkv"})
+        if len(batch) == 10000:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+
+
+def timed(label, collection, find):
+    global received_bytes
+    received_bytes = 0
+    started = time.perf_counter()
+    groups = find(collection)
+    elapsed = time.perf_counter() - started
+    print(f"  {label:<12} {elapsed:8.2f}s {received_bytes / 1e6:9.2f} MB received, {len(groups)} groups")
+    return groups
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare client-side and server-side duplicate ranking for MOB.py")
+    parser.add_argument('--uri', help="MongoDB to benchmark against, e.g. mongodb://localhost:27017 "
+                                      "(default: in-process mongomock)")
+    parser.add_argument('--docs', type=int, default=1000000)
+    parser.add_argument('--duplicates', type=float, default=0.3, help="Share of documents that are duplicates")
+    parser.add_argument('--no-seed', action='store_true', help="Reuse the documents from the previous run (--uri only)")
+    args = parser.parse_args()
+
+    if args.uri:
+        client = MongoClient(args.uri)
+    elif mongomock is not None:
+        client = mongomock.MongoClient()
+    else:
+        parser.error("mongomock is not installed; pass --uri of a MongoDB server")
+    collection = client['bench_mob']['files']
+    if not args.no_seed or not args.uri:
+        started = time.perf_counter()
+        seed(collection, args.docs, args.duplicates)
+        print(f"Seeded {args.docs} documents in {time.perf_counter() - started:.1f}s")
+
+    client_groups = timed('client-side', collection, client_side_groups)
+    server_groups = timed('server-side', collection, server_side_groups)
+
+    # Same groups, and every keeper ranks as well as the best of its group
+    assert client_groups.keys() == server_groups.keys(), "duplicate groups differ"
+    for size, (keep, count) in server_groups.items():
+        client_keep, client_count, names = client_groups[size]
+        assert count == client_count and keep in names, f"size {size}: groups differ"
+        assert MOB.quality_rank(names[keep]) == MOB.quality_rank(names[client_keep]), f"size {size}: worse keeper"
+    print(f"  same {len(server_groups)} groups and {sum(c - 1 for _, c in server_groups.values())} "
+          f"documents to delete either way")
@@ -1,109 +1,1044 @@
 #!/usr/bin/env python3
 import os
 import sys
+import json
+import time
+import random
+import hashlib
+import asyncio
+import argparse
+import threading
+import subprocess
 import requests
+from requests.adapters import HTTPAdapter
 from m3u8 import M3U8
-from urllib.parse import urljoin
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque, namedtuple
+from urllib.parse import urljoin, urlsplit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+MAX_WORKERS = 5
+# Finished segments waiting for an earlier one to complete are held in memory,
+# so this bounds the reorder buffer to REORDER_WINDOW segments.
+REORDER_WINDOW = MAX_WORKERS * 4
+CHUNK_SIZE = 64 * 1024
+# Adjacent byte ranges of one resource are merged into requests of up to this size
+COALESCE_MAX = 8 * 1024 * 1024
+
+RETRIES = 4
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+# Statuses worth retrying; any other HTTP error fails the segment at once
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+# Spare threads used to re-request a segment that is holding up the writer
+HEDGE_WORKERS = 2
+
+class SegmentError(Exception):
+    pass
+
+class TokenBucket:
+    """Token bucket refilled at rate bytes/sec, holding at most burst bytes.
+
+    reserve() never blocks: it takes the tokens, going into debt if need be,
+    and returns how long the caller has to wait before using them. That
+    lets worker threads and coroutines share one bucket, each sleeping in
+    its own way.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(CHUNK_SIZE, rate / 4)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= nbytes
+            return max(0.0, -self._tokens / self.rate)
+
+class RateLimiter:
+    """A global token bucket plus one per origin host, shared by all segment workers"""
+    def __init__(self, rate=None, host_rate=None):
+        self.bucket = TokenBucket(rate) if rate else None
+        self.host_rate = host_rate
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def delay(self, url, nbytes):
+        """Take nbytes from the buckets that apply to url; return the seconds to wait"""
+        delay = self.bucket.reserve(nbytes) if self.bucket else 0.0
+        if self.host_rate:
+            host = urlsplit(url).netloc
+            with self._lock:
+                bucket = self._hosts.get(host)
+                if bucket is None:
+                    bucket = self._hosts[host] = TokenBucket(self.host_rate)
+            delay = max(delay, bucket.reserve(nbytes))
+        return delay
+
+def parse_rate(value):
+    """Parse a bytes/sec figure such as 500000, 800K, 12.5M or 1G"""
+    units = {'K': 1e3, 'M': 1e6, 'G': 1e9}
+    value = value.strip().upper().removesuffix('B/S').removesuffix('B')
+    if value[-1:] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+class FetchPolicy:
+    """How segment requests are made: retries, timeouts, hedging and rate limits"""
+    def __init__(self, retries=RETRIES, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, hedge=True, limiter=None):
+        self.retries = retries
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.hedge = hedge
+        self.limiter = limiter
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    def backoff(self, attempt, retry_after=None):
+        """Seconds to wait before retry number attempt+1.
+
+        A numeric Retry-After from the server wins; otherwise this is
+        exponential backoff with full jitter, so workers that failed
+        together do not retry together.
+        """
+        if retry_after is not None:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                pass
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+class LatencyTracker:
+    """Sliding window of recent segment download times"""
+    def __init__(self, size=200, min_samples=20):
+        self._samples = deque(maxlen=size)
+        self._min_samples = min_samples
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def p95(self):
+        """Return the 95th percentile, or None until enough samples are in"""
+        with self._lock:
+            if len(self._samples) < self._min_samples:
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+_thread_state = threading.local()
+
+def get_session():
+    """Return the calling thread's keep-alive session, creating it on first use"""
+    session = getattr(_thread_state, 'session', None)
+    if session is None:
+        session = requests.Session()
+        # One worker only ever has a single request in flight, so a single
+        # pooled connection per host is enough for TCP and TLS reuse.
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=1)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _thread_state.session = session
+    return session
+
+def range_headers(headers, byte_range):
+    if byte_range is None:
+        return headers
+    start, end = byte_range
+    return dict(headers or {}, Range=f"bytes={start}-{end - 1}")
+
+def check_range(data, status, byte_range):
+    """Return the bytes of byte_range (start, end) from a response body"""
+    if byte_range is None:
+        return data
+    start, end = byte_range
+    if status != 206:
+        # The server ignored Range and sent the whole resource
+        data = data[start:end]
+    if len(data) != end - start:
+        raise ValueError(f"expected {end - start} bytes of range {start}-{end - 1}, got {len(data)}")
+    return data
+
+def download_segment(segment_url, headers=None, policy=None, latency=None, byte_range=None,
+                     cancel=None):
+    """Fetch segment_url with retries; None once they are used up, or as soon as cancel is set"""
+    policy = policy or FetchPolicy()
+    cancelled = cancel.is_set if cancel is not None else lambda: False
+    for attempt in range(policy.retries + 1):
+        if cancelled():
+            return None
+        started = time.monotonic()
+        retry_after = None
+        try:
+            response = get_session().get(segment_url, headers=range_headers(headers, byte_range),
+                                         stream=True, timeout=policy.timeout)
+            if response.status_code in RETRYABLE_STATUSES:
+                retry_after = response.headers.get('Retry-After')
+            response.raise_for_status()
+            data = bytearray()
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if cancelled():
+                    response.close()
+                    return None
+                data += chunk
+                if policy.limiter is not None:
+                    time.sleep(policy.limiter.delay(segment_url, len(chunk)))
+            data = check_range(data, response.status_code, byte_range)
+            if latency is not None:
+                latency.add(time.monotonic() - started)
+            return data
+        except requests.HTTPError as e:
+            error = e
+            if e.response.status_code not in RETRYABLE_STATUSES:
+                break
+        except (requests.RequestException, ValueError) as e:
+            # Connection failures, timeouts and truncated bodies
+            error = e
+        if attempt < policy.retries:
+            delay = policy.backoff(attempt, retry_after)
+            print(f"\nError downloading {segment_url}: {error}; retrying in {delay:.1f}s")
+            if cancel is not None:
+                if cancel.wait(delay):
+                    return None
+            else:
+                time.sleep(delay)
+    print(f"\nError downloading {segment_url}: {error}")
+    return None
+
+def wait_hedged(future, started, hedge, latency, cancel=None):
+    """Return the result of future, racing it against hedge() once it runs past the p95 latency.
+
+    started is filled in with the request's start time once a worker picks
+    it up, so time spent queued behind other segments does not count.
+    cancel is the Event both requests watch: it is set as soon as one of
+    them succeeds, so the other gives up instead of running on through its
+    timeouts and retries.
+    """
+    threshold = latency.p95()
+    while threshold is not None and not future.done():
+        if not started:
+            wait([future], timeout=threshold)
+            continue
+        remaining = started[0] + threshold - time.monotonic()
+        if remaining > 0:
+            wait([future], timeout=remaining)
+            continue
+        backup = hedge()
+        done, _ = wait([future, backup], return_when=FIRST_COMPLETED)
+        first = done.pop()
+        if first.result() is not None:
+            if cancel is not None:
+                cancel.set()
+            return first.result()
+        return (backup if first is future else future).result()
+    return future.result()
+
+# One playlist segment carried by a Fetch. name identifies it in the journal;
+# length is None for a segment that is a whole resource; init is the
+# EXT-X-MAP section to write ahead of it, if it is the first segment to use
+# that section; aes is the (key, iv) it is encrypted with under METHOD=AES-128.
+# plan_fetches fills init and aes with URLs, which resolve_parts swaps for
+# the downloaded bytes.
+Part = namedtuple('Part', 'index name length init aes')
+# One HTTP request: a whole resource when start is None, otherwise the byte
+# range [start, end) covering the parts back to back.
+Fetch = namedtuple('Fetch', 'url start end parts')
+
+def parse_byterange(byterange, next_offset=0):
+    """Return (start, end) for an HLS BYTERANGE value "length[@offset]" """
+    length, _, offset = byterange.partition('@')
+    start = int(offset) if offset else next_offset
+    return start, start + int(length)
+
+def segment_iv(key, sequence):
+    """The AES-128 IV: the key's IV attribute, else the media sequence number (RFC 8216 5.2)"""
+    if key.iv:
+        return bytes.fromhex(key.iv[2:].rjust(32, '0'))
+    return sequence.to_bytes(16, 'big')
+
+def plan_fetches(segments, base_uri, state=None, max_bytes=COALESCE_MAX, first_sequence=0):
+    """Turn media playlist segments into Fetches, merging adjacent byte ranges of one URI.
+
+    state carries the current init section and implicit BYTERANGE offsets
+    between calls, for playlists that are planned a poll at a time.
+    first_sequence is the media sequence number of segments[0].
+    """
+    state = state if state is not None else {}
+    offsets = state.setdefault('offsets', {})
+    fetches = []
+    for index, segment in enumerate(segments):
+        url = urljoin(base_uri, segment.uri)
+
+        aes = None
+        key = segment.key
+        if key is not None and key.method != 'NONE':
+            if key.method != 'AES-128':
+                raise RuntimeError(f"unsupported encryption method {key.method}")
+            aes = (urljoin(base_uri, key.uri), segment_iv(key, first_sequence + index))
+
+        init = None
+        if segment.init_section is not None:
+            map_url = urljoin(base_uri, segment.init_section.uri)
+            map_range = segment.init_section.byterange
+            init_key = (map_url, parse_byterange(map_range) if map_range else None)
+            if init_key != state.get('map'):
+                init = state['map'] = init_key
+
+        if not segment.byterange:
+            fetches.append(Fetch(url, None, None, [Part(index, url, None, init, aes)]))
+            continue
+
+        start, end = parse_byterange(segment.byterange, offsets.get(url, 0))
+        offsets[url] = end
+        part = Part(index, f"{url}#bytes={start}-{end - 1}", end - start, init, aes)
+        last = fetches[-1] if fetches else None
+        if (last is not None and last.url == url and last.end == start
+                and end - last.start <= max_bytes):
+            last.parts.append(part)
+            fetches[-1] = last._replace(end=end)
+        else:
+            fetches.append(Fetch(url, start, end, [part]))
+    return fetches
+
+def skip_segments(fetches, start):
+    """Drop the parts of fetches that come before segment index start"""
+    remaining = []
+    for fetch in fetches:
+        skipped = [part for part in fetch.parts if part.index < start]
+        if not skipped:
+            remaining.append(fetch)
+        elif len(skipped) < len(fetch.parts):
+            remaining.append(fetch._replace(start=fetch.start + sum(part.length for part in skipped),
+                                            parts=fetch.parts[len(skipped):]))
+    return remaining
+
+def resolve_parts(fetches, cache, headers=None, policy=None):
+    """Download each init section and AES key once, and put their bytes on the parts using them"""
+    def load(url, byte_range=None):
+        if (url, byte_range) not in cache:
+            data = download_segment(url, headers, policy, byte_range=byte_range)
+            if data is None:
+                raise SegmentError(f"{url} still failing after retries")
+            cache[url, byte_range] = bytes(data)
+        return cache[url, byte_range]
+
+    for fetch in fetches:
+        for k, part in enumerate(fetch.parts):
+            if part.init is not None:
+                part = part._replace(init=load(*part.init))
+            if part.aes is not None:
+                if Cipher is None:
+                    raise RuntimeError("AES-128 playlists need cryptography: pip install cryptography")
+                key_url, iv = part.aes
+                key = load(key_url)
+                if len(key) != 16:
+                    raise RuntimeError(f"{key_url} is not a 16 byte AES-128 key")
+                part = part._replace(aes=(key, iv))
+            fetch.parts[k] = part
+
+def decrypt_aes128(data, key, iv):
+    """Decrypt one AES-128-CBC segment and strip its PKCS#7 padding"""
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+    plain = decryptor.update(data) + decryptor.finalize()
+    pad = plain[-1] if plain else 0
+    if not 1 <= pad <= 16 or len(plain) < pad:
+        raise SegmentError("bad padding after AES-128 decryption; wrong key or IV?")
+    return memoryview(plain)[:-pad]
+
+def decode_fetch(fetch, data):
+    """Split a downloaded Fetch into (part, chunks) per segment, decrypting as needed.
+
+    This runs on the worker that downloaded the data, so decryption
+    overlaps with other downloads and the writer only ever sees plaintext.
+    """
+    view = memoryview(data)
+    offset = 0
+    decoded = []
+    for part in fetch.parts:
+        length = part.length if part.length is not None else len(view)
+        payload = view[offset:offset + length]
+        offset += length
+        if part.aes is not None:
+            payload = decrypt_aes128(payload, *part.aes)
+        chunks = [payload] if part.init is None else [part.init, payload]
+        decoded.append((part, chunks))
+    return decoded
+
+class SegmentJournal:
+    """Append-only JSON-lines record of the segments already written to an output file.
+
+    The first line names the playlist; every following line records one
+    segment's index, URL, byte length and SHA-256, written only after the
+    segment's bytes have been handed to the output file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def _read(self, m3u8_url):
+        try:
+            with open(self.path) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return []
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # A crash can leave the last line half written
+                break
+        if not records or records[0].get('m3u8_url') != m3u8_url:
+            return []
+        return records[1:]
+
+    def resume(self, m3u8_url, segment_keys, output_filename):
+        """Return (start, offset): how many segments of output_filename can be kept, and their size.
+
+        Only records that describe a contiguous prefix of the current playlist
+        and fit inside the output file survive; the journal is rewritten to
+        that prefix and left open for appending.
+        """
+        records = self._read(m3u8_url)
+        try:
+            size = os.path.getsize(output_filename)
+        except OSError:
+            records, size = [], 0
+
+        valid, offset = [], 0
+        for i, record in enumerate(records):
+            if (record.get('index') != i or i >= len(segment_keys)
+                    or record.get('url') != segment_keys[i]
+                    or offset + record['length'] > size):
+                break
+            valid.append(record)
+            offset += record['length']
+
+        # The segment written last before a crash is the one most likely to be
+        # torn, so check its bytes and fall back until one matches
+        if valid:
+            with open(output_filename, 'rb') as f:
+                while valid:
+                    last = valid[-1]
+                    f.seek(offset - last['length'])
+                    if hashlib.sha256(f.read(last['length'])).hexdigest() == last['sha256']:
+                        break
+                    valid.pop()
+                    offset -= last['length']
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for record in [{'m3u8_url': m3u8_url}] + valid:
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'a')
+        return len(valid), offset
+
+    def record(self, index, segment_key, chunks):
+        digest = hashlib.sha256()
+        for chunk in chunks:
+            digest.update(chunk)
+        line = json.dumps({
+            'index': index,
+            'url': segment_key,
+            'length': sum(len(chunk) for chunk in chunks),
+            'sha256': digest.hexdigest(),
+        })
+        self._file.write(line + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+def store_fetch(outfile, journal, fetch, total, decoded, status=''):
+    """Append the segments of one finished Fetch to the output and journal them"""
+    if decoded is None:
+        raise SegmentError(f"segment {fetch.parts[0].index + 1} ({fetch.url}) still failing after retries")
+    for part, chunks in decoded:
+        for chunk in chunks:
+            outfile.write(chunk)
+        if journal is not None:
+            # The journal must never get ahead of the bytes it describes
+            outfile.flush()
+            journal.record(part.index, part.name, chunks)
+    print(f"Downloaded segment {fetch.parts[-1].index + 1}/{total}{status}", end='\r')
+
+def write_segments(executor, fetches, outfile, headers=None, window=REORDER_WINDOW,
+                   journal=None, policy=None):
+    """Run fetches in parallel and append their segments to outfile in playlist order"""
+    policy = policy or FetchPolicy()
+    total = fetches[-1].parts[-1].index + 1 if fetches else 0
+    queued = iter(fetches)
+    pending = deque()
+    latency = LatencyTracker()
+    # Only the segment at the head of the queue is ever hedged, since it is the
+    # one holding back the writer; its backups get their own threads so they
+    # do not wait behind the rest of the window.
+    hedger = ThreadPoolExecutor(max_workers=HEDGE_WORKERS)
+
+    def run(fetch, started, cancel):
+        started.append(time.monotonic())
+        byte_range = (fetch.start, fetch.end) if fetch.start is not None else None
+        data = download_segment(fetch.url, headers, policy, latency, byte_range, cancel)
+        return decode_fetch(fetch, data) if data is not None else None
+
+    def submit_next():
+        fetch = next(queued, None)
+        if fetch is not None:
+            started, cancel = [], threading.Event()
+            pending.append((fetch, started, cancel, executor.submit(run, fetch, started, cancel)))
+
+    for _ in range(window):
+        submit_next()
 
-def download_segment(segment_url, output_path, headers=None):
     try:
-        response = requests.get(segment_url, headers=headers, stream=True)
-        response.raise_for_status()
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+        while pending:
+            fetch, started, cancel, future = pending.popleft()
+            if policy.hedge:
+                decoded = wait_hedged(future, started, lambda: hedger.submit(run, fetch, [], cancel),
+                                      latency, cancel)
+            else:
+                decoded = future.result()
+            store_fetch(outfile, journal, fetch, total, decoded)
+            submit_next()
+    finally:
+        for _, _, cancel, future in pending:
+            cancel.set()
+            future.cancel()
+        hedger.shutdown(wait=False)
+
+class AIMDController:
+    """Additive-increase/multiplicative-decrease cap on in-flight async requests.
+
+    Every time `limit` requests have completed, that round is compared with
+    the previous one. Only a real gain in throughput earns one more request in
+    flight: at least half of what the last increase could have added, or 5%
+    after a round at the same cap. A plateau holds the cap, since more
+    requests on a saturated link or a slow origin only queue up. The cap shrinks by a quarter when
+    throughput falls, or when requests take much longer than the quickest
+    round seen so far without going any faster. A throttled (429) or
+    otherwise retryable failure halves the cap, at most once per round trip.
+    """
+    # Throughput must beat the previous round by this much to count as a gain
+    # when the cap did not change in between
+    GAIN = 1.05
+    # and fall below this share of it to count as a loss
+    LOSS = 0.9
+    # Mean latency this many times the best round's means requests are queueing
+    QUEUEING = 2.0
+
+    def __init__(self, initial=4, minimum=1, maximum=256):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._slots = asyncio.Condition()
+        self._last_rate = 0.0
+        self._last_limit = initial
+        self._min_latency = None
+        self._last_backoff = 0.0
+        self._start_round(time.monotonic())
+
+    def _start_round(self, now):
+        self._round_started = now
+        self._round_bytes = 0
+        self._round_done = 0
+        self._round_latency = 0.0
+
+    async def acquire(self):
+        async with self._slots:
+            await self._slots.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, started, nbytes, failed=False):
+        async with self._slots:
+            self.in_flight -= 1
+            self._record(started, nbytes, failed)
+            self._slots.notify_all()
+
+    def _record(self, started, nbytes, failed):
+        now = time.monotonic()
+        if failed:
+            # Requests already in flight when we backed off would otherwise
+            # halve the limit again for the same congestion event
+            if started >= self._last_backoff:
+                self.limit = max(self.minimum, self.limit // 2)
+                self._last_backoff = now
+                self._last_rate = 0.0
+                self._start_round(now)
+            return
+
+        self._round_bytes += nbytes
+        self._round_done += 1
+        self._round_latency += now - started
+        if self._round_done >= self.limit:
+            rate = self._round_bytes / max(now - self._round_started, 1e-6)
+            latency = self._round_latency / self._round_done
+            if self._min_latency is None or latency < self._min_latency:
+                self._min_latency = latency
+            queueing = latency > self._min_latency * self.QUEUEING
+            if self.limit > self._last_limit:
+                gain = 1 + (self.limit / self._last_limit - 1) / 2
+            else:
+                gain = self.GAIN
+            self._last_limit = self.limit
+            if rate > self._last_rate * gain:
+                self.limit = min(self.maximum, self.limit + 1)
+            elif rate < self._last_rate * self.LOSS or queueing:
+                self.limit = max(self.minimum, self.limit * 3 // 4)
+            self._last_rate = rate
+            self._start_round(now)
+
+async def download_segment_async(client, controller, segment_url, headers=None, policy=None,
+                                 latency=None, started=None, byte_range=None):
+    """Async download_segment; controller may be None for hedges, which skip the AIMD limit"""
+    policy = policy or FetchPolicy()
+    for attempt in range(policy.retries + 1):
+        slot = await controller.acquire() if controller else time.monotonic()
+        if started is not None and not started:
+            started.append(slot)
+        data = bytearray()
+        congested = False
+        retry_after = None
+        try:
+            async with client.get(segment_url, headers=range_headers(headers, byte_range)) as response:
+                if response.status in RETRYABLE_STATUSES:
+                    retry_after = response.headers.get('Retry-After')
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    data += chunk
+                    if policy.limiter is not None:
+                        await asyncio.sleep(policy.limiter.delay(segment_url, len(chunk)))
+                data = check_range(data, response.status, byte_range)
+            if latency is not None:
+                latency.add(time.monotonic() - slot)
+            return data
+        except aiohttp.ClientResponseError as e:
+            error = e
+            if e.status not in RETRYABLE_STATUSES:
+                break
+            congested = True
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            error = e
+            congested = True
+        finally:
+            if controller:
+                await controller.release(slot, len(data), congested)
+        if attempt < policy.retries:
+            delay = policy.backoff(attempt, retry_after)
+            print(f"\nError downloading {segment_url}: {error}; retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+    print(f"\nError downloading {segment_url}: {error}")
+    return None
+
+async def wait_hedged_async(task, started, hedge, latency):
+    """Async wait_hedged; the losing request is cancelled rather than left running"""
+    threshold = latency.p95()
+    while threshold is not None and not task.done():
+        if not started:
+            await asyncio.wait({task}, timeout=threshold)
+            continue
+        remaining = started[0] + threshold - time.monotonic()
+        if remaining > 0:
+            await asyncio.wait({task}, timeout=remaining)
+            continue
+        backup = asyncio.ensure_future(hedge())
+        done, _ = await asyncio.wait({task, backup}, return_when=asyncio.FIRST_COMPLETED)
+        first = done.pop()
+        other = backup if first is task else task
+        if first.result() is not None:
+            other.cancel()
+            return first.result()
+        return await other
+    return await task
+
+async def write_segments_async(fetches, outfile, headers=None, journal=None, policy=None):
+    """Async counterpart of write_segments whose concurrency adapts to the origin"""
+    policy = policy or FetchPolicy()
+    total = fetches[-1].parts[-1].index + 1 if fetches else 0
+    queued = iter(fetches)
+    pending = deque()
+    latency = LatencyTracker()
+    controller = AIMDController()
+    # The controller decides how many requests are in flight, not the connector
+    connector = aiohttp.TCPConnector(limit=0, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=policy.connect_timeout,
+                                    sock_read=policy.read_timeout)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as client:
+        async def run(fetch, controller=None, started=None):
+            byte_range = (fetch.start, fetch.end) if fetch.start is not None else None
+            data = await download_segment_async(client, controller, fetch.url, headers, policy,
+                                                latency, started, byte_range)
+            if data is None:
+                return None
+            if any(part.aes is not None for part in fetch.parts):
+                # Keep decryption off the event loop
+                return await asyncio.to_thread(decode_fetch, fetch, data)
+            return decode_fetch(fetch, data)
+
+        def fill():
+            while len(pending) < controller.limit + REORDER_WINDOW:
+                fetch = next(queued, None)
+                if fetch is None:
+                    return
+                started = []
+                pending.append((fetch, started, asyncio.ensure_future(run(fetch, controller, started))))
+
+        fill()
+        while pending:
+            fetch, started, task = pending.popleft()
+            if policy.hedge:
+                decoded = await wait_hedged_async(task, started, lambda: run(fetch), latency)
+            else:
+                decoded = await task
+            store_fetch(outfile, journal, fetch, total, decoded,
+                        status=f" ({controller.limit} in flight)")
+            fill()
+
+def load_playlist(playlist_url, headers=None, policy=None):
+    policy = policy or FetchPolicy()
+    response = get_session().get(playlist_url, headers=headers, timeout=policy.timeout)
+    response.raise_for_status()
+    return M3U8(response.text, base_uri=playlist_url[:playlist_url.rfind('/')+1])
+
+def record_live(playlist_url, m3u8_obj, outfile, headers=None, policy=None, duration=None):
+    """Follow a live or EVENT media playlist until #EXT-X-ENDLIST or for duration seconds"""
+    policy = policy or FetchPolicy()
+    deadline = time.monotonic() + duration if duration else None
+    # Media sequence numbers only ever grow, so the next number to record is
+    # all the dedup state we need: whatever came before it is a prefix of
+    # every later playlist and can be skipped by index, however long we run.
+    # An origin that restarts its stream numbers from scratch is the one
+    # exception, and is recorded again from the start of its new playlist.
+    next_sequence = None
+    recorded = 0
+    failed_polls = 0
+    plan_state = {}
+    resource_cache = {}
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        while True:
+            polled = time.monotonic()
+            first_sequence = m3u8_obj.media_sequence or 0
+            if next_sequence is None:
+                next_sequence = first_sequence
+            skip = next_sequence - first_sequence
+            if skip < 0:
+                print(f"\nWarning: {-skip} segments left the playlist before they could be fetched")
+                skip = 0
+            elif skip > len(m3u8_obj.segments):
+                # Further ahead than the playlist reaches: the media sequence went back
+                print(f"\nWarning: media sequence restarted at {first_sequence} "
+                      f"(expected {next_sequence}); recording from the new playlist")
+                skip = 0
+            new_segments = m3u8_obj.segments[skip:]
+            if new_segments:
+                fetches = plan_fetches(new_segments, m3u8_obj.base_uri, plan_state,
+                                       first_sequence=first_sequence + skip)
+                resolve_parts(fetches, resource_cache, headers, policy)
+                write_segments(executor, fetches, outfile, headers, policy=policy)
+                outfile.flush()
+                next_sequence = first_sequence + skip + len(new_segments)
+                recorded += len(new_segments)
+                print(f"\nRecorded {recorded} segments (media sequence {next_sequence - 1})")
+
+            if m3u8_obj.is_endlist:
+                print("Playlist ended")
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                print("Recording time limit reached")
+                return
+
+            # Poll once per target duration, or after half of one if nothing
+            # changed, as clients are asked to in RFC 8216 section 6.3.4
+            target = m3u8_obj.target_duration or 6
+            delay = (target if new_segments else target / 2) - (time.monotonic() - polled)
+            if deadline is not None:
+                delay = min(delay, deadline - time.monotonic())
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                m3u8_obj = load_playlist(playlist_url, headers, policy)
+                failed_polls = 0
+            except requests.RequestException as e:
+                failed_polls += 1
+                if failed_polls > policy.retries:
+                    raise
+                print(f"\nError reloading playlist: {e}")
+
+class VariantPolicy:
+    """Chooses the variant stream and audio rendition to fetch from a master playlist.
+
+    Variants taller than max_height, above max_bandwidth (bits/sec) or
+    faster than max_frame_rate are ruled out, and variants in the preferred
+    codec family win over the rest; of what remains, the highest bandwidth
+    is chosen. Any object with the same choose() and choose_audio() methods
+    can stand in for this one.
+    """
+    CODEC_FAMILIES = {
+        'avc': ('avc1', 'avc3'),
+        'hevc': ('hvc1', 'hev1'),
+        'av1': ('av01',),
+    }
+
+    def __init__(self, max_height=None, codec=None, max_bandwidth=None, max_frame_rate=None,
+                 audio_language=None):
+        self.max_height = max_height
+        self.codec = codec
+        self.max_bandwidth = max_bandwidth
+        self.max_frame_rate = max_frame_rate
+        self.audio_language = audio_language
+
+    def allows(self, playlist):
+        info = playlist.stream_info
+        if self.max_height and info.resolution and info.resolution[1] > self.max_height:
+            return False
+        if self.max_bandwidth and info.bandwidth > self.max_bandwidth:
+            return False
+        if self.max_frame_rate and info.frame_rate and info.frame_rate > self.max_frame_rate:
+            return False
         return True
-    except Exception as e:
-        print(f"Error downloading {segment_url}: {e}")
-        return False
 
-def download_hls_video(m3u8_url, output_filename=None, headers=None):
+    def has_codec(self, playlist):
+        prefixes = self.CODEC_FAMILIES.get(self.codec, (self.codec,))
+        codecs = (playlist.stream_info.codecs or '').split(',')
+        return any(codec.strip().startswith(prefixes) for codec in codecs)
+
+    def choose(self, playlists):
+        candidates = [p for p in playlists if self.allows(p)]
+        if not candidates:
+            # Nothing fits; the lowest bandwidth variant is the nearest miss
+            print("No variant meets the selection limits, taking the smallest")
+            return min(playlists, key=lambda p: p.stream_info.bandwidth)
+        if self.codec:
+            candidates = [p for p in candidates if self.has_codec(p)] or candidates
+        return max(candidates, key=lambda p: p.stream_info.bandwidth)
+
+    def choose_audio(self, media, variant):
+        """Return the EXT-X-MEDIA audio rendition to fetch alongside variant, if it has its own URI"""
+        group = variant.stream_info.audio
+        renditions = [m for m in media if m.type == 'AUDIO' and m.group_id == group and m.uri]
+        if not group or not renditions:
+            return None
+        if self.audio_language:
+            for rendition in renditions:
+                if (rendition.language or '').lower() == self.audio_language.lower():
+                    return rendition
+        for rendition in renditions:
+            if rendition.default == 'YES':
+                return rendition
+        return renditions[0]
+
+def describe_variant(playlist):
+    info = playlist.stream_info
+    parts = []
+    if info.resolution:
+        parts.append(f"{info.resolution[0]}x{info.resolution[1]}")
+    if info.frame_rate:
+        parts.append(f"{info.frame_rate:g}fps")
+    if info.codecs:
+        parts.append(info.codecs)
+    parts.append(f"{info.bandwidth // 1000} kbps")
+    return ' '.join(parts)
+
+def download_media_playlist(playlist_url, m3u8_obj, output_filename, headers=None, engine='threads',
+                            policy=None, live=False, live_duration=None):
+    """Download every segment of one media playlist into output_filename"""
+    if live:
+        # A live playlist only releases a segment or two per poll, so there
+        # is nothing for the async engine's adaptive concurrency to do
+        with open(output_filename, 'wb') as outfile:
+            record_live(playlist_url, m3u8_obj, outfile, headers, policy, live_duration)
+        return
+    
+    # Download all segments
+    segments = m3u8_obj.segments
+    print(f"Found {len(segments)} segments to download...")
+    fetches = plan_fetches(segments, m3u8_obj.base_uri,
+                           first_sequence=m3u8_obj.media_sequence or 0)
+    if len(fetches) < len(segments):
+        print(f"Coalesced byte ranges into {len(fetches)} requests")
+    
+    # Pick up where an interrupted run of the same download left off
+    journal = SegmentJournal(output_filename + '.journal')
+    segment_names = [part.name for fetch in fetches for part in fetch.parts]
+    start, offset = journal.resume(playlist_url, segment_names, output_filename)
+    if start:
+        print(f"Resuming after {start} completed segments ({offset} bytes)")
+        fetches = skip_segments(fetches, start)
+    resolve_parts(fetches, {}, headers, policy)
+    
+    # Download segments in parallel, streaming them straight into the output file
+    started = time.monotonic()
+    with open(output_filename, 'r+b' if start else 'wb') as outfile:
+        outfile.truncate(offset)
+        outfile.seek(offset)
+        if engine == 'async':
+            asyncio.run(write_segments_async(fetches, outfile, headers, journal, policy))
+        else:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                write_segments(executor, fetches, outfile, headers,
+                               journal=journal, policy=policy)
+        written = outfile.tell() - offset
+    elapsed = time.monotonic() - started
+    
+    journal.remove()
+    print(f"\n{output_filename}: {written / 1e6:.1f} MB in {elapsed:.1f}s "
+          f"({written / 1e6 / max(elapsed, 1e-6):.1f} MB/s)")
+
+def mux_renditions(video_path, audio_path, output_path):
+    """Mux separately downloaded video and audio into one file without re-encoding"""
+    print("Muxing video and audio...")
+    ffmpeg_cmd = [
+        'ffmpeg',
+        '-hide_banner',
+        '-loglevel', 'error',
+        '-y',
+        '-i', video_path,
+        '-i', audio_path,
+        '-c', 'copy',
+        '-map', '0:v:0',
+        '-map', '1:a:0',
+        output_path
+    ]
+    subprocess.run(ffmpeg_cmd, check=True)
+
+def download_hls_video(m3u8_url, output_filename=None, headers=None, engine='threads', policy=None,
+                       live=False, live_duration=None, variant_policy=None):
     if not output_filename:
         output_filename = "output.mp4"
+    policy = policy or FetchPolicy()
+    variant_policy = variant_policy or VariantPolicy()
     
     try:
-        # Parse the master playlist
-        response = requests.get(m3u8_url, headers=headers)
-        response.raise_for_status()
+        if engine == 'async' and aiohttp is None:
+            raise RuntimeError("the async engine needs aiohttp: pip install aiohttp")
         
-        # Load the m3u8 content
-        base_url = m3u8_url[:m3u8_url.rfind('/')+1]
-        m3u8_obj = M3U8(response.text, base_uri=base_url)
+        # Parse the master playlist
+        m3u8_obj = load_playlist(m3u8_url, headers, policy)
+        playlist_url = m3u8_url
+        audio_url = None
         
-        # Get the best quality stream (highest bandwidth)
+        # Pick the variant (and its separate audio, if any) the policy asks for
         if m3u8_obj.playlists:
-            best_quality = max(m3u8_obj.playlists, key=lambda p: p.stream_info.bandwidth)
-            playlist_url = urljoin(base_url, best_quality.uri)
-            response = requests.get(playlist_url, headers=headers)
-            response.raise_for_status()
-            m3u8_obj = M3U8(response.text, base_uri=playlist_url[:playlist_url.rfind('/')+1])
-        
-        # Download all segments
-        segments = m3u8_obj.segments
-        print(f"Found {len(segments)} segments to download...")
-        
-        # Create temp directory for segments
-        temp_dir = "temp_segments"
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # Download segments in parallel
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            futures = []
-            for i, segment in enumerate(segments):
-                segment_url = urljoin(m3u8_obj.base_uri, segment.uri)
-                segment_path = os.path.join(temp_dir, f"segment_{i:04d}.ts")
-                futures.append(executor.submit(download_segment, segment_url, segment_path, headers))
-            
-            # Wait for all downloads to complete
-            for i, future in enumerate(futures):
-                if future.result():
-                    print(f"Downloaded segment {i+1}/{len(segments)}", end='\r')
-                else:
-                    print(f"\nFailed to download segment {i+1}")
+            variant = variant_policy.choose(m3u8_obj.playlists)
+            print(f"Selected variant {describe_variant(variant)}")
+            audio = variant_policy.choose_audio(m3u8_obj.media, variant)
+            if audio is not None:
+                audio_url = urljoin(m3u8_obj.base_uri, audio.uri)
+                print(f"Selected audio {audio.name or audio.group_id} ({audio.language or 'und'})")
+            playlist_url = urljoin(m3u8_obj.base_uri, variant.uri)
+            m3u8_obj = load_playlist(playlist_url, headers, policy)
         
-        # Combine segments into one file
-        with open(output_filename, 'wb') as outfile:
-            for i in range(len(segments)):
-                segment_path = os.path.join(temp_dir, f"segment_{i:04d}.ts")
-                try:
-                    with open(segment_path, 'rb') as infile:
-                        outfile.write(infile.read())
-                except FileNotFoundError:
-                    print(f"\nMissing segment {i}, skipping")
+        options = dict(headers=headers, engine=engine, policy=policy, live=live, live_duration=live_duration)
+        if audio_url is None:
+            download_media_playlist(playlist_url, m3u8_obj, output_filename, **options)
+        else:
+            video_path = output_filename + '.video'
+            audio_path = output_filename + '.audio'
+            with ThreadPoolExecutor(max_workers=1) as audio_worker:
+                audio_job = audio_worker.submit(download_media_playlist, audio_url,
+                                                load_playlist(audio_url, headers, policy),
+                                                audio_path, **options)
+                download_media_playlist(playlist_url, m3u8_obj, video_path, **options)
+                audio_job.result()
+            try:
+                mux_renditions(video_path, audio_path, output_filename)
+            except (subprocess.CalledProcessError, FileNotFoundError) as e:
+                print(f"\nError muxing video and audio: {e}")
+                print(f"The downloaded streams are kept as {video_path} and {audio_path}")
+                sys.exit(1)
+            for path in (video_path, audio_path):
+                os.remove(path)
         
         print(f"\nVideo successfully saved as {output_filename}")
         
+    except SegmentError as e:
+        print(f"\nError: {e}")
+        if not live:
+            print("Completed segments are kept; run the same command again to resume.")
+        sys.exit(1)
     except Exception as e:
         print(f"\nError: {e}")
         sys.exit(1)
-        
-    finally:
-        # Clean up temp files
-        if os.path.exists(temp_dir):
-            for i in range(len(segments)):
-                segment_path = os.path.join(temp_dir, f"segment_{i:04d}.ts")
-                try:
-                    os.remove(segment_path)
-                except FileNotFoundError:
-                    pass
-            try:
-                os.rmdir(temp_dir)
-            except OSError:
-                pass
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python dl.py <m3u8_url> [output_filename]")
-        print("Example: python dl.py https://example.com/playlist.m3u8 video.mp4")
-        sys.exit(1)
-    
-    m3u8_url = sys.argv[1]
-    output_filename = sys.argv[2] if len(sys.argv) > 2 else None
+    parser = argparse.ArgumentParser(
+        description="Download an HLS stream into a single file",
+        epilog="Example: python dl.py https://example.com/playlist.m3u8 video.mp4")
+    parser.add_argument('m3u8_url', help="Master or media playlist URL")
+    parser.add_argument('output_filename', nargs='?', help="Output file (default: output.mp4)")
+    parser.add_argument('--engine', choices=['threads', 'async'], default='threads',
+                        help=f"threads: {MAX_WORKERS} worker threads; async: aiohttp with adaptive concurrency")
+    parser.add_argument('--retries', type=int, default=RETRIES,
+                        help=f"Retries per segment before giving up (default: {RETRIES})")
+    parser.add_argument('--connect-timeout', type=float, default=CONNECT_TIMEOUT,
+                        help=f"Seconds to wait for a connection (default: {CONNECT_TIMEOUT})")
+    parser.add_argument('--read-timeout', type=float, default=READ_TIMEOUT,
+                        help=f"Seconds a stalled read may block (default: {READ_TIMEOUT})")
+    parser.add_argument('--no-hedge', dest='hedge', action='store_false',
+                        help="Don't re-request segments slower than the p95 so far")
+    parser.add_argument('--live', action='store_true',
+                        help="Keep polling a live or EVENT playlist and record new segments as they appear")
+    parser.add_argument('--live-duration', type=float, metavar='SECONDS',
+                        help="With --live, stop recording after this many seconds")
+    parser.add_argument('--rate', type=parse_rate, metavar='BYTES/S',
+                        help="Cap total download rate across all segment workers, e.g. 20M")
+    parser.add_argument('--host-rate', type=parse_rate, metavar='BYTES/S',
+                        help="Cap download rate per origin host, e.g. 5M")
+    parser.add_argument('--max-height', type=int, metavar='PIXELS',
+                        help="Skip variants taller than this, e.g. 1080")
+    parser.add_argument('--codec', choices=sorted(VariantPolicy.CODEC_FAMILIES),
+                        help="Prefer variants in this video codec family")
+    parser.add_argument('--max-bandwidth', type=parse_rate, metavar='BITS/S',
+                        help="Skip variants whose BANDWIDTH is above this, e.g. 6M")
+    parser.add_argument('--max-fps', type=float, metavar='FPS',
+                        help="Skip variants with a higher frame rate")
+    parser.add_argument('--audio-lang', metavar='LANG',
+                        help="Preferred language of a separate audio rendition, e.g. en")
+    args = parser.parse_args()
     
     # Optional: Add headers if needed (e.g., for authenticated streams)
     headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
     }
     
-    download_hls_video(m3u8_url, output_filename, headers)
+    limiter = RateLimiter(args.rate, args.host_rate) if args.rate or args.host_rate else None
+    policy = FetchPolicy(retries=args.retries, connect_timeout=args.connect_timeout,
+                         read_timeout=args.read_timeout, hedge=args.hedge, limiter=limiter)
+    variant_policy = VariantPolicy(max_height=args.max_height, codec=args.codec,
+                                   max_bandwidth=args.max_bandwidth, max_frame_rate=args.max_fps,
+                                   audio_language=args.audio_lang)
+    download_hls_video(args.m3u8_url, args.output_filename, headers, engine=args.engine, policy=policy,
+                       live=args.live, live_duration=args.live_duration, variant_policy=variant_policy)
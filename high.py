@@ -1,15 +1,291 @@
 import subprocess
+import argparse
+import hashlib
+import shutil
+import signal
+import heapq
+import tempfile
+import json
+import glob
+import threading
+import time
 import os
 import sys
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def convert_to_heaac_5_1(input_file, output_file=None):
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# Inputs picked up when batch mode is given a directory
+AUDIO_EXTENSIONS = {
+    '.wav', '.flac', '.aiff', '.m4a', '.mp4', '.mov', '.mka', '.mkv',
+    '.aac', '.ac3', '.eac3', '.ec3', '.dts', '.thd', '.mp3', '.ogg', '.opus', '.wma',
+}
+OUTPUT_SUFFIX = '_heaac.m4a'
+# Encoding ladder rungs: output suffix, filter on the rung's branch of the
+# decoded audio (or None), encoder options. heaac51 matches convert_to_heaac_5_1
+LADDER_PROFILES = {
+    'heaac51': (OUTPUT_SUFFIX, 'channelmap=channel_layout=5.1',
+                ['-c:a', 'libfdk_aac', '-profile:a', 'aac_he_v2', '-b:a', '128k', '-ar', '48000',
+                 '-ac', '6', '-channel_layout', '5.1']),
+    'stereo': ('_stereo.m4a', None, ['-c:a', 'aac', '-b:a', '160k', '-ar', '48000', '-ac', '2']),
+    'opus': ('_opus.ogg', None, ['-c:a', 'libopus', '-b:a', '96k', '-ac', '2']),
+}
+DEFAULT_LADDER = ['heaac51', 'stereo', 'opus']
+# Everything we write, finished or partial, so it is never taken as an input
+OUTPUT_SUFFIXES = tuple(name for suffix, _, _ in LADDER_PROFILES.values()
+                        for name in (suffix, suffix.replace('.', '.partial.', 1)))
+
+# What convert_to_heaac_5_1 produces, for deciding whether a source already has it
+TARGET_PROFILES = {'HE-AAC', 'HE-AACv2'}
+TARGET_CHANNELS = 6
+TARGET_SAMPLE_RATE = 48000
+TARGET_BIT_RATE = 128000
+# ffprobe results keyed by content fingerprint, shared by every run on this machine:
+# one JSON line per probe, only ever appended to, so concurrent runs add to it safely
+PROBE_CACHE = Path(os.environ.get('HIGH_PROBE_CACHE', Path.home() / '.cache' / 'high_probe.jsonl'))
+FINGERPRINT_BYTES = 1024 * 1024
+
+# Watch mode: seconds a dropped file must go unchanged before it is queued,
+# jobs held in the queue at most, and where the queue survives restarts
+SETTLE_SECONDS = 5
+QUEUE_SIZE = 1000
+WATCH_STATE = Path.home() / '.cache' / 'high_watch_state.json'
+# Rough input bytes/sec of one conversion, for ordering the queue by expected finish
+ENCODE_RATE = 4 * 1024 * 1024
+
+# JSON-lines file that every conversion's ffmpeg progress events are appended to
+PROGRESS_LOG = os.environ.get('HIGH_PROGRESS_LOG')
+
+_progress_log_lock = threading.Lock()
+_probe_cache = {}
+_probe_cache_offset = 0
+_probe_cache_lock = threading.Lock()
+
+def file_fingerprint(path):
+    """
+    SHA-256 of a file's size and its first and last megabyte
+    
+    Stands in for a full content hash as the probe cache key: reading whole
+    multi-gigabyte masters would cost far more than the ffprobe it saves,
+    while container headers and trailers still change with any re-encode or remux.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(FINGERPRINT_BYTES))
+        if size > FINGERPRINT_BYTES:
+            f.seek(max(FINGERPRINT_BYTES, size - FINGERPRINT_BYTES))
+            digest.update(f.read(FINGERPRINT_BYTES))
+    return digest.hexdigest()
+
+def probe_audio(input_file):
+    """
+    Describe a file's container and first audio stream with ffprobe, through the probe cache
+    
+    Returns:
+        dict: format_name, stream_count, and the audio stream's codec_name, profile,
+            channels, channel_layout, sample_rate and bit_rate; None if there is no
+            audio stream or ffprobe is unavailable or fails
+    """
+    try:
+        key = file_fingerprint(input_file)
+    except OSError:
+        return None
+    with _probe_cache_lock:
+        if key not in _probe_cache:
+            # Another run may have probed it since we last looked
+            read_probe_cache()
+        if key in _probe_cache:
+            return _probe_cache[key]
+    
+    try:
+        result = subprocess.run(['ffprobe', '-v', 'error', '-print_format', 'json',
+                                 '-show_format', '-show_streams', str(input_file)],
+                                check=True, capture_output=True, text=True)
+        info = json.loads(result.stdout)
+    except (subprocess.CalledProcessError, FileNotFoundError, ValueError):
+        return None
+    streams = info.get('streams', [])
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), None)
+    if audio is None:
+        return None
+    bit_rate = audio.get('bit_rate') or info.get('format', {}).get('bit_rate')
+    probe = {
+        'format_name': info.get('format', {}).get('format_name', ''),
+        'stream_count': len(streams),
+        'codec_name': audio.get('codec_name'),
+        'profile': audio.get('profile'),
+        'channels': audio.get('channels'),
+        'channel_layout': audio.get('channel_layout'),
+        'sample_rate': int(audio.get('sample_rate') or 0),
+        'bit_rate': int(bit_rate) if bit_rate else None,
+    }
+    
+    with _probe_cache_lock:
+        _probe_cache[key] = probe
+    try:
+        PROBE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        # A single O_APPEND write, so lines from concurrent runs never interleave
+        fd = os.open(PROBE_CACHE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps([key, probe]) + '\n').encode())
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+    return probe
+
+def read_probe_cache():
+    """Take in the probe cache lines appended since the last read, by any run; call with the lock held"""
+    global _probe_cache_offset
+    try:
+        with open(PROBE_CACHE, 'rb') as f:
+            # Shorter than what we have read: truncated or replaced, so read it from the start
+            if os.fstat(f.fileno()).st_size < _probe_cache_offset:
+                _probe_cache_offset = 0
+            f.seek(_probe_cache_offset)
+            data = f.read()
+    except OSError:
+        return
+    # A line still being written is left for next time
+    data = data[:data.rfind(b'\n') + 1]
+    _probe_cache_offset += len(data)
+    for line in data.splitlines():
+        try:
+            key, probe = json.loads(line)
+        except ValueError:
+            continue
+        _probe_cache[key] = probe
+
+def choose_conversion(probe, output_file):
+    """
+    Pick the cheapest way to turn a probed input into the HE-AAC 5.1 target
+    
+    Returns:
+        str: 'copy' when the input already is an audio-only MP4 with the target
+            stream (the file is copied as is), 'remux' when the audio stream matches
+            but the container or its other streams do not (stream copy, no decode),
+            or 'encode' for a full decode and re-encode
+    """
+    if probe is None:
+        return 'encode'
+    matches = (
+        probe['codec_name'] == 'aac'
+        and probe['profile'] in TARGET_PROFILES
+        and probe['channels'] == TARGET_CHANNELS
+        and probe['channel_layout'] in ('5.1', '5.1(side)')
+        and probe['sample_rate'] == TARGET_SAMPLE_RATE
+        # Unknown is fine; a higher bitrate source is brought down to target
+        and (probe['bit_rate'] is None or probe['bit_rate'] <= TARGET_BIT_RATE * 1.1)
+    )
+    if not matches:
+        return 'encode'
+    if ('mp4' in probe['format_name'].split(',') and probe['stream_count'] == 1
+            and Path(output_file).suffix.lower() in ('.m4a', '.mp4')):
+        return 'copy'
+    return 'remux'
+
+def parse_progress(lines):
+    """
+    Group the key=value lines of ffmpeg's -progress output into one dict per report
+    
+    ffmpeg ends every report with a progress=continue line, and the last one
+    with progress=end.
+    """
+    report = {}
+    for line in lines:
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        report[key] = value.strip()
+        if key == 'progress':
+            yield report
+            report = {}
+
+def progress_event(report, input_file, elapsed):
+    """
+    Turn one -progress report into a progress event
+    
+    Returns:
+        dict: input, out_time (seconds of output written), speed (multiple of
+        realtime), bitrate (kbit/s), total_size (bytes), elapsed (wall seconds)
+        and done. Values ffmpeg reports as N/A are None.
+    """
+    def number(key, unit='', cast=float):
+        value = report.get(key, 'N/A')
+        try:
+            return cast(value[:-len(unit)] if unit and value.endswith(unit) else value)
+        except ValueError:
+            return None
+    
+    # out_time_ms is in microseconds too; older ffmpeg only sends that one
+    out_time = number('out_time_us', cast=int)
+    if out_time is None:
+        out_time = number('out_time_ms', cast=int)
+    return {
+        'input': str(input_file),
+        'out_time': None if out_time is None else out_time / 1e6,
+        'speed': number('speed', 'x'),
+        'bitrate': number('bitrate', 'kbits/s'),
+        'total_size': number('total_size', cast=int),
+        'elapsed': round(elapsed, 3),
+        'done': report.get('progress') == 'end',
+    }
+
+def log_progress(event):
+    """Append a progress event to PROGRESS_LOG"""
+    line = json.dumps(dict(event, time=round(time.time(), 3))) + '\n'
+    with _progress_log_lock:
+        with open(PROGRESS_LOG, 'a') as f:
+            f.write(line)
+
+def run_ffmpeg(ffmpeg_cmd, input_file, quiet=False, on_progress=None):
+    """
+    Run ffmpeg, feeding its progress reports to on_progress and PROGRESS_LOG
+    
+    Raises subprocess.CalledProcessError on failure, with ffmpeg's stderr
+    attached when quiet.
+    """
+    listeners = [listener for listener in (on_progress, PROGRESS_LOG and log_progress) if listener]
+    if not listeners:
+        subprocess.run(ffmpeg_cmd, check=True, capture_output=quiet, text=True)
+        return
+    
+    ffmpeg_cmd = [ffmpeg_cmd[0], '-progress', 'pipe:1', *ffmpeg_cmd[1:]]
+    stderr = []
+    started = time.monotonic()
+    with subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE if quiet else None,
+                          text=True) as process:
+        if quiet:
+            # Drain stderr alongside, or a chatty ffmpeg could block on a full pipe
+            reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+            reader.start()
+        for report in parse_progress(process.stdout):
+            event = progress_event(report, input_file, time.monotonic() - started)
+            for listener in listeners:
+                listener(event)
+        if quiet:
+            reader.join()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, ffmpeg_cmd, stderr=''.join(stderr) if quiet else None)
+
+def convert_to_heaac_5_1(input_file, output_file=None, quiet=False, probe=True, on_progress=None):
     """
     Convert audio file to HE-AAC 5.1 128kbps CBR 48000Hz
     
     Args:
         input_file (str): Path to input audio file
         output_file (str, optional): Path to output file. If None, will use input file with _heaac.m4a suffix
+        quiet (bool, optional): Keep ffmpeg's output off the terminal and only report errors,
+            for running many conversions side by side
+        probe (bool, optional): Probe the input first and copy or remux its audio instead
+            of re-encoding when it already is HE-AAC 5.1 at 48 kHz
+        on_progress (callable, optional): Called with a progress_event dict about twice
+            a second while ffmpeg runs, and once more with done=True at the end
         
     Returns:
         str: Path to converted file
@@ -17,40 +293,562 @@ def convert_to_heaac_5_1(input_file, output_file=None):
     # Set output file if not provided
     if output_file is None:
         input_path = Path(input_file)
-        output_file = input_path.with_name(f"{input_path.stem}_heaac.m4a")
-    
-    # FFmpeg command for HE-AAC 5.1 conversion
-    ffmpeg_cmd = [
-        'ffmpeg',
-        '-i', input_file,
-        '-c:a', 'libfdk_aac',
-        '-profile:a', 'aac_he_v2',
-        '-b:a', '128k',
-        '-ar', '48000',
-        '-ac', '6',
-        '-channel_layout', '5.1',
-        '-filter_complex', 'channelmap=channel_layout=5.1',
-        '-vn',
-        '-y',
-        str(output_file)
-    ]
+        output_file = input_path.with_name(f"{input_path.stem}{OUTPUT_SUFFIX}")
+    
+    method = choose_conversion(probe_audio(input_file), output_file) if probe else 'encode'
+    if method == 'copy':
+        try:
+            shutil.copyfile(input_file, output_file)
+        except shutil.SameFileError:
+            pass
+        except OSError as e:
+            print(f"Error copying {input_file}: {e}")
+            return None
+        if not quiet:
+            print(f"Already HE-AAC 5.1, copied to {output_file}")
+        return str(output_file)
+    
+    if method == 'remux':
+        # The audio is already right: take the stream over without decoding it
+        ffmpeg_cmd = ['ffmpeg', '-i', input_file, '-map', '0:a:0', '-c:a', 'copy', '-vn', '-y', str(output_file)]
+    else:
+        # FFmpeg command for HE-AAC 5.1 conversion
+        ffmpeg_cmd = [
+            'ffmpeg',
+            '-i', input_file,
+            '-c:a', 'libfdk_aac',
+            '-profile:a', 'aac_he_v2',
+            '-b:a', '128k',
+            '-ar', '48000',
+            '-ac', '6',
+            '-channel_layout', '5.1',
+            '-filter_complex', 'channelmap=channel_layout=5.1',
+            '-vn',
+            '-y',
+            str(output_file)
+        ]
+    if quiet:
+        ffmpeg_cmd[1:1] = ['-hide_banner', '-nostdin', '-loglevel', 'error']
     
     try:
-        subprocess.run(ffmpeg_cmd, check=True)
-        print(f"Successfully converted to {output_file}")
+        run_ffmpeg(ffmpeg_cmd, input_file, quiet, on_progress)
+        if not quiet:
+            print(f"Successfully {'remuxed' if method == 'remux' else 'converted'} to {output_file}")
         return str(output_file)
-    except subprocess.CalledProcessError as e:
-        print(f"Error during conversion: {e}")
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        report_ffmpeg_error(e, input_file, quiet)
         return None
-    except FileNotFoundError:
+
+def report_ffmpeg_error(error, input_file, quiet):
+    if isinstance(error, FileNotFoundError):
         print("FFmpeg not found. Please install FFmpeg with libfdk_aac support.")
+    elif quiet and error.stderr.strip():
+        print(f"Error converting {input_file}: {error.stderr.strip().splitlines()[-1]}")
+    else:
+        print(f"Error during conversion: {error}")
+
+def encode_ladder(input_file, profiles=DEFAULT_LADDER, out_dir=None, quiet=False, on_progress=None):
+    """
+    Encode audio file to several LADDER_PROFILES in a single ffmpeg run
+    
+    The source is read and decoded once; asplit hands the decoded audio to
+    every rung's filter and encoder, which ffmpeg runs side by side. With
+    three rungs that is a third of the decode work and source reads of
+    running convert_to_heaac_5_1 and friends once per output.
+    
+    Args:
+        input_file (str): Path to input audio file
+        profiles (list, optional): LADDER_PROFILES names, one output each
+        out_dir (str, optional): Directory for the outputs. If None, they go next to the input
+        quiet (bool, optional): As for convert_to_heaac_5_1
+        on_progress (callable, optional): As for convert_to_heaac_5_1; events cover the whole run
+        
+    Returns:
+        dict: Output path per profile, or None if the run failed (then no outputs are left)
+    """
+    # A rung asked for twice would have two encoders writing the same file
+    profiles = list(dict.fromkeys(profiles))
+    input_path = Path(input_file)
+    directory = Path(out_dir) if out_dir is not None else input_path.parent
+    outputs = {name: directory / f"{input_path.stem}{LADDER_PROFILES[name][0]}" for name in profiles}
+    # Written under temporary names and renamed together once ffmpeg succeeds
+    partials = {name: path.with_name(f"{path.stem}.partial{path.suffix}") for name, path in outputs.items()}
+    
+    branches = [f"[a{i}]" for i in range(len(profiles))]
+    graph = [f"[0:a:0]asplit={len(profiles)}{''.join(branches)}"]
+    rungs = []
+    for i, name in enumerate(profiles):
+        suffix, branch_filter, options = LADDER_PROFILES[name]
+        branch = branches[i]
+        if branch_filter:
+            graph.append(f"{branch}{branch_filter}[o{i}]")
+            branch = f"[o{i}]"
+        rungs += ['-map', branch, *options, str(partials[name])]
+    ffmpeg_cmd = ['ffmpeg', '-i', str(input_file), '-filter_complex', ';'.join(graph), '-y', *rungs]
+    if quiet:
+        ffmpeg_cmd[1:1] = ['-hide_banner', '-nostdin', '-loglevel', 'error']
+    
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        run_ffmpeg(ffmpeg_cmd, input_file, quiet, on_progress)
+        for name in profiles:
+            os.replace(partials[name], outputs[name])
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
+        report_ffmpeg_error(e, input_file, quiet)
+        for partial in partials.values():
+            partial.unlink(missing_ok=True)
         return None
+    if not quiet:
+        print(f"Successfully encoded {', '.join(profiles)} to {directory}")
+    return {name: str(path) for name, path in outputs.items()}
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def collect_inputs(patterns):
+    """
+    Expand files, directories and glob patterns into (input file, base directory) pairs
+    
+    Directories are searched recursively for AUDIO_EXTENSIONS files. The base
+    directory is what output paths are made relative to under --out-dir.
+    Our own outputs, finished or partial, are never taken as inputs.
+    """
+    inputs = {}
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_dir():
+            matches = [(p, path) for p in sorted(path.rglob('*')) if p.suffix.lower() in AUDIO_EXTENSIONS]
+        elif path.is_file():
+            matches = [(path, path.parent)]
+        else:
+            matches = [(Path(p), Path(p).parent) for p in sorted(glob.glob(pattern, recursive=True))]
+        for input_path, base in matches:
+            if input_path.is_file() and not input_path.name.endswith(OUTPUT_SUFFIXES):
+                inputs.setdefault(input_path, base)
+    return list(inputs.items())
+
+def batch_output_path(input_path, base, out_dir=None):
+    name = f"{input_path.stem}{OUTPUT_SUFFIX}"
+    if out_dir is None:
+        return input_path.with_name(name)
+    return Path(out_dir) / input_path.relative_to(base).with_name(name)
+
+def is_up_to_date(input_path, output_path, check, source_hash=None):
+    """
+    Whether output_path already holds the conversion of input_path
+    
+    'mtime' trusts an output newer than its input. 'hash' compares the
+    input's SHA-256 with the one recorded next to the output when it was
+    made, so touched-but-unchanged inputs are skipped and edited ones are
+    not, whatever the clocks say. source_hash is that SHA-256 when the
+    caller already has it, so the input is not read twice.
+    """
+    if not output_path.exists():
+        return False
+    if check == 'mtime':
+        return output_path.stat().st_mtime >= input_path.stat().st_mtime
+    hash_file = Path(f"{output_path}.sha256")
+    if not hash_file.exists():
+        return False
+    return hash_file.read_text().strip() == (source_hash or file_sha256(input_path))
+
+def convert_one(input_path, output_path, check):
+    """Batch worker: convert unless up to date; returns 'converted', 'skipped' or 'failed'"""
+    # Hashed once: to compare with the output's record, then to record it for the new output
+    source_hash = file_sha256(input_path) if check == 'hash' else None
+    if is_up_to_date(input_path, output_path, check, source_hash):
+        return 'skipped'
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    # Write under a temporary name so an interrupted run never leaves a
+    # partial file that looks up to date
+    partial = output_path.with_name(f"{output_path.stem}.partial{output_path.suffix}")
+    if convert_to_heaac_5_1(str(input_path), str(partial), quiet=True) is None:
+        partial.unlink(missing_ok=True)
+        return 'failed'
+    os.replace(partial, output_path)
+    if source_hash is not None:
+        Path(f"{output_path}.sha256").write_text(source_hash + '\n')
+    return 'converted'
+
+def convert_batch(patterns, out_dir=None, jobs=None, check='mtime'):
+    """
+    Convert every input matched by patterns, several at a time
+    
+    Args:
+        patterns (list): Files, directories and glob patterns
+        out_dir (str, optional): Directory for the outputs, mirroring each input's
+            place under its directory argument. If None, outputs go next to their inputs
+        jobs (int, optional): Conversions to run at once. If None, one per CPU core
+        check (str): How to tell an output is up to date: 'mtime' or 'hash'
+        
+    Returns:
+        dict: Input paths grouped under 'converted', 'skipped' and 'failed'
+    """
+    inputs = collect_inputs(patterns)
+    jobs = jobs or os.cpu_count() or 1
+    results = {'converted': [], 'skipped': [], 'failed': []}
+    started = time.monotonic()
+    if not inputs:
+        print("No input files found")
+        return results
+    
+    # Each conversion is its own ffmpeg process; these threads only start and wait on them
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(convert_one, input_path, batch_output_path(input_path, base, out_dir), check): input_path
+            for input_path, base in inputs
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                outcome = future.result()
+            except OSError as e:
+                print(f"Error converting {futures[future]}: {e}")
+                outcome = 'failed'
+            results[outcome].append(str(futures[future]))
+            elapsed = time.monotonic() - started
+            eta = elapsed / done * (len(inputs) - done)
+            print(f"[{done}/{len(inputs)}] {len(results['converted'])} converted, "
+                  f"{len(results['skipped'])} up to date, {len(results['failed'])} failed, "
+                  f"{elapsed:.0f}s elapsed, ~{eta:.0f}s left", end='\r')
+    
+    print()
+    print(f"Batch finished in {time.monotonic() - started:.1f}s with {jobs} parallel jobs: "
+          f"{len(results['converted'])} converted, {len(results['skipped'])} already up to date, "
+          f"{len(results['failed'])} failed")
+    for input_file in results['failed']:
+        print(f"  failed: {input_file}")
+    return results
+
+class WatchDaemon:
+    """
+    Convert audio dropped into watched folders as soon as each file has finished arriving
+    
+    A file becomes a job once it has been closed or moved in and then left
+    alone for SETTLE_SECONDS with its size unchanged, so copies in progress
+    are never picked up half written. Jobs wait in a bounded priority queue
+    ordered by arrival time plus expected conversion time: short files
+    overtake long ones that arrived a little earlier, but a long file is
+    never starved. When the queue is full, settled files wait their turn.
+    
+    The queue is saved to the state file on every change, and interrupted
+    jobs are put back, so a restart loses nothing; a rescan at startup also
+    picks up whatever arrived while the daemon was down.
+    """
+    def __init__(self, folders, out_dir=None, jobs=None, settle=SETTLE_SECONDS,
+                 state_file=WATCH_STATE, queue_size=QUEUE_SIZE):
+        self.folders = [Path(folder).resolve() for folder in folders]
+        self.out_dir = out_dir
+        self.jobs = jobs or os.cpu_count() or 1
+        self.settle = settle
+        self.state_file = Path(state_file)
+        self.queue_size = queue_size
+        # Path -> (time of the last change, size then) for files still settling
+        self.pending = {}
+        self.queue = []
+        self.queued = set()
+        self.running = set()
+        self.stopping = False
+        self.cond = threading.Condition()
+    
+    def is_candidate(self, path):
+        name = path.name
+        return (path.suffix.lower() in AUDIO_EXTENSIONS and not name.startswith('.')
+                and not name.endswith(OUTPUT_SUFFIXES))
+    
+    def output_path(self, path):
+        base = next((folder for folder in self.folders if path.is_relative_to(folder)), path.parent)
+        return batch_output_path(path, base, self.out_dir)
+    
+    def changed(self, path):
+        """(Re)start the settle timer for path"""
+        if not self.is_candidate(path):
+            return
+        try:
+            size = path.stat().st_size
+        except OSError:
+            return
+        with self.cond:
+            self.pending[path] = (time.monotonic(), size)
+    
+    def scan(self):
+        """Treat every input without an up-to-date output as just dropped"""
+        for path, base in collect_inputs([str(folder) for folder in self.folders]):
+            path = path.resolve()
+            if self.is_candidate(path) and path not in self.queued and path not in self.running:
+                if not is_up_to_date(path, self.output_path(path), 'mtime'):
+                    self.changed(path)
+    
+    def save_state(self):
+        """Write the queue (running jobs first, as they restart) and settling files; call with cond held"""
+        state = {
+            'queue': [[0, str(path)] for path in self.running] + [[key, str(path)] for key, path in self.queue],
+            'pending': [str(path) for path in self.pending],
+        }
+        try:
+            self.state_file.parent.mkdir(parents=True, exist_ok=True)
+            partial = self.state_file.with_name(f"{self.state_file.name}.tmp")
+            partial.write_text(json.dumps(state))
+            os.replace(partial, self.state_file)
+        except OSError as e:
+            print(f"Error saving watch state: {e}")
+    
+    def load_state(self):
+        try:
+            state = json.loads(self.state_file.read_text())
+        except (OSError, ValueError):
+            return
+        with self.cond:
+            for key, path in state.get('queue', []):
+                path = Path(path)
+                if path.exists() and path not in self.queued:
+                    heapq.heappush(self.queue, (key, path))
+                    self.queued.add(path)
+        for path in state.get('pending', []):
+            self.changed(Path(path))
+        if self.queue:
+            print(f"Resuming {len(self.queue)} queued jobs")
+    
+    def promote_settled(self):
+        """Move files that have stopped changing from pending into the queue"""
+        now = time.monotonic()
+        with self.cond:
+            for path, (changed_at, size) in list(self.pending.items()):
+                if now - changed_at < self.settle:
+                    continue
+                try:
+                    current = path.stat().st_size
+                except OSError:
+                    del self.pending[path]
+                    continue
+                if current != size:
+                    # Still growing without closing it (e.g. over a network share)
+                    self.pending[path] = (now, current)
+                    continue
+                if len(self.queue) >= self.queue_size:
+                    break
+                del self.pending[path]
+                if path not in self.queued:
+                    heapq.heappush(self.queue, (time.time() + size / ENCODE_RATE, path))
+                    self.queued.add(path)
+                    print(f"Queued {path}")
+                self.save_state()
+                self.cond.notify()
+    
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopping:
+                    self.cond.wait()
+                if self.stopping:
+                    return
+                key, path = heapq.heappop(self.queue)
+                self.queued.discard(path)
+                self.running.add(path)
+                self.save_state()
+            
+            started = time.monotonic()
+            try:
+                outcome = convert_one(path, self.output_path(path), 'mtime')
+            except OSError as e:
+                print(f"Error converting {path}: {e}")
+                outcome = 'failed'
+            
+            with self.cond:
+                self.running.discard(path)
+                if outcome == 'failed' and self.stopping:
+                    # Most likely ffmpeg was stopped along with us: run it again after the restart
+                    heapq.heappush(self.queue, (key, path))
+                    self.queued.add(path)
+                self.save_state()
+            if outcome == 'converted':
+                print(f"Converted {path} in {time.monotonic() - started:.1f}s")
+    
+    def watch_inotify(self):
+        inotify = INotify()
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE
+        watches = {}
+        
+        def add_tree(directory):
+            for sub in [directory, *(p for p in directory.rglob('*') if p.is_dir())]:
+                try:
+                    watches[inotify.add_watch(sub, mask)] = sub
+                except OSError:
+                    pass
+        
+        for folder in self.folders:
+            add_tree(folder)
+        while not self.stopping:
+            for event in inotify.read(timeout=1000):
+                if event.mask & flags.Q_OVERFLOW:
+                    self.scan()
+                    continue
+                directory = watches.get(event.wd)
+                if directory is None or not event.name:
+                    continue
+                path = directory / event.name
+                if event.mask & flags.ISDIR:
+                    # A folder dropped or created here: watch it and take what is already in it
+                    add_tree(path)
+                    for child in path.rglob('*'):
+                        if child.is_file():
+                            self.changed(child)
+                elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                    self.changed(path)
+    
+    def watch_polling(self):
+        # Without inotify: notice new or changed files by their size and mtime.
+        # The first pass only records them; scan() has already dealt with those
+        seen = None
+        while not self.stopping:
+            first, seen = seen is None, seen or {}
+            for path, base in collect_inputs([str(folder) for folder in self.folders]):
+                try:
+                    st = path.stat()
+                except OSError:
+                    continue
+                signature = (st.st_size, st.st_mtime_ns)
+                if seen.get(path) != signature:
+                    seen[path] = signature
+                    if not first:
+                        self.changed(path.resolve())
+            time.sleep(max(1, self.settle / 2))
+    
+    def stop(self, signum=None, frame=None):
+        print("Stopping: letting running conversions finish, queue saved")
+        with self.cond:
+            self.stopping = True
+            self.save_state()
+            self.cond.notify_all()
+    
+    def run(self):
+        self.load_state()
+        self.scan()
+        workers = [threading.Thread(target=self.work) for _ in range(self.jobs)]
+        for worker in workers:
+            worker.start()
+        watcher = self.watch_inotify if INotify is not None else self.watch_polling
+        threading.Thread(target=watcher, daemon=True).start()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print(f"Watching {', '.join(map(str, self.folders))} with {self.jobs} workers")
+        
+        while not self.stopping:
+            self.promote_settled()
+            time.sleep(0.5)
+        for worker in workers:
+            worker.join()
+
+def set_progress_log(path):
+    global PROGRESS_LOG
+    PROGRESS_LOG = path
+
+def watch_main(argv):
+    parser = argparse.ArgumentParser(prog='high.py watch',
+                                     description="Convert audio to HE-AAC 5.1 as it is dropped into folders")
+    parser.add_argument('folders', nargs='+', help="Folders to watch (subfolders included)")
+    parser.add_argument('-o', '--out-dir', help="Write outputs here instead of next to each input")
+    parser.add_argument('-j', '--jobs', type=int, help="Conversions at once (default: one per CPU core)")
+    parser.add_argument('--settle', type=float, default=SETTLE_SECONDS,
+                        help=f"Seconds a file must stay unchanged before it is converted (default: {SETTLE_SECONDS})")
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help=f"Most jobs held in the queue (default: {QUEUE_SIZE})")
+    parser.add_argument('--state', default=str(WATCH_STATE), help=f"Queue state file (default: {WATCH_STATE})")
+    parser.add_argument('--progress-log', default=PROGRESS_LOG,
+                        help="Append ffmpeg progress events here as JSON lines (default: $HIGH_PROGRESS_LOG)")
+    args = parser.parse_args(argv)
+    set_progress_log(args.progress_log)
+    for folder in args.folders:
+        if not Path(folder).is_dir():
+            print(f"Error: '{folder}' is not a folder")
+            sys.exit(1)
+    WatchDaemon(args.folders, args.out_dir, args.jobs, args.settle, args.state, args.queue_size).run()
+    sys.exit(0)
+
+def compare_ladder(input_file, profiles):
+    """Time one ladder run against one run per rung; returns ffmpeg (CPU, wall) seconds for each"""
+    timings = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for runs in ([profiles], [[name] for name in profiles]):
+            before, started = os.times(), time.monotonic()
+            for rung_profiles in runs:
+                if encode_ladder(input_file, rung_profiles, tmp, quiet=True) is None:
+                    return None
+            after = os.times()
+            cpu = after.children_user + after.children_system - before.children_user - before.children_system
+            timings.append((cpu, time.monotonic() - started))
+    return timings
+
+def ladder_main(argv):
+    parser = argparse.ArgumentParser(prog='high.py ladder',
+                                     description="Encode each input to several profiles, decoding it only once")
+    parser.add_argument('inputs', nargs='+', help="Input files, directories (searched recursively) or glob patterns")
+    parser.add_argument('-p', '--profiles', default=','.join(DEFAULT_LADDER),
+                        help=f"Comma-separated rungs out of {', '.join(LADDER_PROFILES)} (default: all)")
+    parser.add_argument('-o', '--out-dir', help="Write outputs here instead of next to each input")
+    parser.add_argument('--compare', action='store_true',
+                        help="Don't keep outputs; report ffmpeg CPU and wall time against one run per rung")
+    parser.add_argument('--progress-log', default=PROGRESS_LOG,
+                        help="Append ffmpeg progress events here as JSON lines (default: $HIGH_PROGRESS_LOG)")
+    args = parser.parse_args(argv)
+    set_progress_log(args.progress_log)
+    profiles = list(dict.fromkeys(name.strip() for name in args.profiles.split(',') if name.strip()))
+    unknown = [name for name in profiles if name not in LADDER_PROFILES]
+    if unknown or not profiles:
+        print(f"Error: unknown profile {', '.join(unknown)}; choose from {', '.join(LADDER_PROFILES)}")
+        sys.exit(1)
+    
+    failed = 0
+    for input_path, base in collect_inputs(args.inputs):
+        if args.compare:
+            timings = compare_ladder(str(input_path), profiles)
+            if timings is None:
+                failed += 1
+                continue
+            (ladder_cpu, ladder_wall), (rungs_cpu, rungs_wall) = timings
+            print(f"{input_path}: one run {ladder_cpu:.2f}s CPU, {ladder_wall:.2f}s wall; "
+                  f"one per rung {rungs_cpu:.2f}s CPU, {rungs_wall:.2f}s wall "
+                  f"({rungs_cpu / max(ladder_cpu, 1e-9):.1f}x CPU)")
+            continue
+        out_dir = batch_output_path(input_path, base, args.out_dir).parent if args.out_dir else None
+        if encode_ladder(str(input_path), profiles, out_dir) is None:
+            failed += 1
+    sys.exit(1 if failed else 0)
+
+def batch_main(argv):
+    parser = argparse.ArgumentParser(prog='high.py batch',
+                                     description="Convert many files to HE-AAC 5.1 in parallel")
+    parser.add_argument('inputs', nargs='+', help="Input files, directories (searched recursively) or glob patterns")
+    parser.add_argument('-o', '--out-dir', help="Write outputs here instead of next to each input")
+    parser.add_argument('-j', '--jobs', type=int, help="Conversions at once (default: one per CPU core)")
+    parser.add_argument('--check', choices=['mtime', 'hash'], default='mtime',
+                        help="Skip inputs whose output is newer (mtime) or was made from identical content (hash)")
+    parser.add_argument('--progress-log', default=PROGRESS_LOG,
+                        help="Append ffmpeg progress events here as JSON lines (default: $HIGH_PROGRESS_LOG)")
+    args = parser.parse_args(argv)
+    set_progress_log(args.progress_log)
+    results = convert_batch(args.inputs, args.out_dir, args.jobs, args.check)
+    sys.exit(1 if results['failed'] else 0)
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        batch_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'watch':
+        watch_main(sys.argv[2:])
+    if len(sys.argv) > 1 and sys.argv[1] == 'ladder':
+        ladder_main(sys.argv[2:])
+    
     if len(sys.argv) < 2:
         print("Usage: python3 high.py input_file [output_file]")
+        print("       python3 high.py batch [-o OUT_DIR] [-j JOBS] [--check mtime|hash] inputs...")
+        print("       python3 high.py watch [-o OUT_DIR] [-j JOBS] [--settle SECONDS] folders...")
+        print("       python3 high.py ladder [-p heaac51,stereo,opus] [-o OUT_DIR] [--compare] inputs...")
         print("Example: python3 high.py audio.m4a")
         print("Example: python3 high.py input.wav output.m4a")
+        print("Example: python3 high.py batch -o converted/ masters/ 'extras/**/*.wav'")
         sys.exit(1)
     
     input_file = sys.argv[1]
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""Load test for the my.py download server: throughput, time to first byte and server CPU"""
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+
+def tree_cpu_seconds(pid):
+    """User plus system CPU time of pid and all of its descendants, from /proc"""
+    processes = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                data = f.read()
+        except OSError:
+            continue
+        # Fields after the parenthesised command name: state, ppid, ... utime, stime
+        fields = data[data.rindex(')') + 2:].split()
+        processes[int(entry)] = (int(fields[1]), int(fields[11]) + int(fields[12]))
+
+    ticks, todo = 0, [pid]
+    while todo:
+        current = todo.pop()
+        ticks += processes.get(current, (0, 0))[1]
+        todo.extend(child for child, (parent, _) in processes.items() if parent == current)
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+
+def wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server did not start listening on port {port}")
+
+
+# Server variants to compare: label, extra serve flags, extra environment
+COMPARISONS = {
+    'sendfile': [('sendfile', [], {}), ('read loop', ['--no-sendfile'], {})],
+    'metrics': [('metrics', [], {}), ('no metrics', [], {'MY_METRICS': '0'})],
+    'cache': [('cache', ['--cache-bytes', '1G'], {}), ('no cache', [], {})],
+}
+
+
+def start_server(args, flags, extra_env):
+    env = dict(os.environ, MEDIA_FOLDER=args.media_dir, **extra_env)
+    cmd = [sys.executable, 'my.py', 'serve', '--workers', str(args.workers),
+           '--threads', str(args.threads), '--bind', f'127.0.0.1:{args.port}', *flags]
+    server = subprocess.Popen(cmd, env=env, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(args.port)
+    return server
+
+
+def download(port, path, requests, results, ttfbs):
+    """Fetch path requests times over one keep-alive connection"""
+    buffer = bytearray(1024 * 1024)
+    conn = http.client.HTTPConnection('127.0.0.1', port)
+    received = 0
+    for _ in range(requests):
+        started = time.perf_counter()
+        conn.request('GET', path)
+        response = conn.getresponse()
+        # One byte, not a buffer's worth: readinto blocks until the buffer is full
+        first = response.read(1)
+        ttfbs.append(time.perf_counter() - started)
+        received += len(first)
+        n = response.readinto(buffer)
+        while n:
+            received += n
+            n = response.readinto(buffer)
+    conn.close()
+    results.append(received)
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[round(p / 100 * (len(ordered) - 1))]
+
+
+def run_clients(port, path, clients, requests, server_pid):
+    """Run clients concurrent downloaders; return (seconds, bytes, TTFB samples, server CPU seconds)"""
+    results, ttfbs = [], []
+    threads = [threading.Thread(target=download, args=(port, path, requests, results, ttfbs))
+               for _ in range(clients)]
+    cpu_before = tree_cpu_seconds(server_pid)
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    return elapsed, sum(results), ttfbs, tree_cpu_seconds(server_pid) - cpu_before
+
+
+def ensure_test_file(args):
+    path = os.path.join(args.media_dir, args.file)
+    if not os.path.exists(path) or os.path.getsize(path) != args.size:
+        os.makedirs(args.media_dir, exist_ok=True)
+        block = os.urandom(1024 * 1024)
+        with open(path, 'wb') as f:
+            for _ in range(args.size // len(block)):
+                f.write(block)
+            f.write(block[:args.size % len(block)])
+    return '/download/' + args.file
+
+
+def parse_size(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper()
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare my.py serving paths under concurrent downloads")
+    parser.add_argument('--media-dir', default='/tmp/my-loadtest', help="MEDIA_FOLDER for the test server")
+    parser.add_argument('--file', default='loadtest.bin', help="Test file, created in --media-dir if missing")
+    parser.add_argument('--size', type=parse_size, default=parse_size('64M'), help="Test file size, e.g. 256M")
+    parser.add_argument('--concurrency', default='1,16,128', help="Comma-separated client counts")
+    parser.add_argument('--compare', choices=sorted(COMPARISONS), default='sendfile',
+                        help="sendfile: zero-copy vs read loop; metrics: /metrics collection on vs off; "
+                             "cache: hot-file cache on vs off")
+    parser.add_argument('--requests', type=int, default=4, help="Downloads per client, over one connection")
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--port', type=int, default=18080)
+    args = parser.parse_args()
+
+    path = ensure_test_file(args)
+    levels = [int(n) for n in args.concurrency.split(',')]
+
+    print(f"{args.size / 2**20:g} MiB file, {args.requests} requests per client, "
+          f"my.py serve with {args.workers} workers x {args.threads} threads")
+    print(f"{'server':<10} {'clients':>7} {'req/s':>8} {'MB/s':>9} {'MB/s/client':>12} {'CPU%':>7} {'CPU%/client':>12} "
+          f"{'TTFB p50':>9} {'TTFB p99':>9}")
+    for name, flags, extra_env in COMPARISONS[args.compare]:
+        server = start_server(args, flags, extra_env)
+        try:
+            for clients in levels:
+                elapsed, received, ttfbs, cpu = run_clients(args.port, path, clients, args.requests, server.pid)
+                rate = received / elapsed / 1e6
+                cpu_percent = cpu / elapsed * 100
+                print(f"{name:<10} {clients:>7} {clients * args.requests / elapsed:>8.0f} {rate:>9.1f} "
+                      f"{rate / clients:>12.1f} {cpu_percent:>7.1f} {cpu_percent / clients:>12.2f} "
+                      f"{percentile(ttfbs, 50) * 1000:>7.1f}ms {percentile(ttfbs, 99) * 1000:>7.1f}ms")
+        finally:
+            server.terminate()
+            server.wait()
@@ -1,18 +1,1420 @@
-from flask import Flask, send_from_directory, abort
+from flask import Flask, Response, abort, g, jsonify, request
+from werkzeug.http import http_date, parse_date, parse_etags, parse_if_range_header, parse_range_header, quote_etag
+from werkzeug.security import safe_join
+from werkzeug.wsgi import ClosingIterator
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from urllib.parse import quote
+import argparse
+import bisect
+import fcntl
+import hashlib
+import heapq
+import json
+import mimetypes
+import mmap
+import queue
+import shutil
+import signal
+import socket
+import threading
+import time
+import unicodedata
+import uuid
+import stat
+import tempfile
+import zlib
 import os
 
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 app = Flask(__name__)
 
 # Path to the directory containing your media files
-MEDIA_FOLDER = '/root'  # Make sure the files you want to serve are readable here
+MEDIA_FOLDER = os.environ.get('MEDIA_FOLDER', '/root')  # Make sure the files you want to serve are readable here
+
+# Hand whole-file and single-range bodies to the server's wsgi.file_wrapper,
+# which sendfile-capable servers such as gunicorn send with os.sendfile
+USE_SENDFILE = os.environ.get('MY_SENDFILE', '1') != '0'
+CHUNK_SIZE = 256 * 1024
+# A Range header asking for more pieces than this is answered with the whole file
+MAX_RANGES = 64
+
+# Content hashes for the listing, computed in the background by one process
+# at a time and kept in HASH_STORE across restarts; MY_INDEX_HASH=1 turns them on
+INDEX_HASH = os.environ.get('MY_INDEX_HASH', '0') != '0'
+HASH_STORE = os.environ.get('MY_HASH_STORE', os.path.join(os.path.expanduser('~'), '.cache', 'my_hashes.jsonl'))
+# How often processes that are not hashing pick up the hasher's results (seconds)
+HASH_POLL = 5
+# Without inotify the index is rebuilt this often instead (seconds)
+INDEX_RESCAN = int(os.environ.get('MY_INDEX_RESCAN', '300'))
+LIST_LIMIT = 100
+MAX_LIST_LIMIT = 1000
+
+# Text formats worth compressing; everything else (video, audio, images) is sent as is
+COMPRESSIBLE_TYPES = {
+    'application/json', 'application/xml', 'application/javascript', 'application/x-subrip',
+    'application/vnd.apple.mpegurl', 'application/x-mpegurl', 'audio/mpegurl', 'image/svg+xml',
+}
+# Smaller files are not worth a compressor and a chunked response
+COMPRESS_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# Precompressed copies next to the original, in order of preference
+SIDECARS = [('zstd', '.zst'), ('gzip', '.gz')]
+
+def parse_rate(value):
+    """Parse a bytes/sec figure such as 500000, 800K, 12.5M or 1G"""
+    units = {'K': 1e3, 'M': 1e6, 'G': 1e9}
+    value = value.strip().upper().removesuffix('B/S').removesuffix('B')
+    if value[-1:] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+def env_rate(name):
+    value = os.environ.get(name)
+    return parse_rate(value) if value else None
+
+# Download limits, off when unset or 0. Concurrent transfers per client
+# address and in total (beyond them requests get 429 and 503), and byte
+# rates per transfer, per client address and overall
+IP_CONNECTIONS = int(os.environ.get('MY_IP_CONNECTIONS', '0'))
+MAX_TRANSFERS = int(os.environ.get('MY_MAX_TRANSFERS', '0'))
+CONNECTION_RATE = env_rate('MY_CONNECTION_RATE')
+IP_RATE = env_rate('MY_IP_RATE')
+RATE = env_rate('MY_RATE')
+# Seconds a rejected client is asked to wait
+RETRY_AFTER = 5
+# Rate-limited bodies go out in smaller pieces so pacing stays smooth
+THROTTLE_CHUNK = 64 * 1024
+
+def parse_size(value):
+    """Parse a byte count such as 65536, 512K, 64M or 2G (binary units)"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().removesuffix('B')
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+# Memory for the hot-file cache, per process (0, the default, turns it off),
+# the largest file it takes, and how many requests a file needs to get in
+CACHE_BYTES = parse_size(os.environ.get('MY_CACHE_BYTES', '0'))
+CACHE_MAX_FILE = parse_size(os.environ.get('MY_CACHE_MAX_FILE', '64M'))
+CACHE_ADMIT = 2
+
+# Metrics for /metrics; MY_METRICS=0 turns collection off
+METRICS = os.environ.get('MY_METRICS', '1') != '0'
+# Where each gunicorn worker leaves a snapshot for the others to merge (set by serve)
+METRICS_DIR = os.environ.get('MY_METRICS_DIR')
+METRICS_FLUSH = 2
+TTFB_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5]
+DURATION_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+# Files tracked by the hot list, and how many of them are exported
+HOT_FILES = 256
+HOT_FILES_SHOWN = 20
+
+mimetypes.add_type('text/x-ssa', '.ass')
+mimetypes.add_type('text/x-ssa', '.ssa')
+
+class TokenBucket:
+    """Token bucket refilled at rate bytes/sec, holding at most burst bytes.
+
+    reserve() never blocks: it takes the tokens, going into debt if need be,
+    and returns how long the caller has to wait before sending them.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(THROTTLE_CHUNK, rate / 4)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, nbytes):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= nbytes
+            return max(0.0, -self._tokens / self.rate)
+
+class SharedClients:
+    """Per-address transfer counts and token buckets shared by processes.
+
+    Each client address has a small JSON file in path, read and rewritten
+    under flock, so the serve workers enforce one per-address limit between
+    them rather than one each. Transfers are counted per process, and
+    processes that have gone are dropped from the count, so a worker killed
+    mid-download does not hold its clients' slots forever. As in Throttle,
+    an address's state goes once its last transfer ends.
+    """
+    def __init__(self, path, ip_connections=0, ip_rate=None):
+        self.path = path
+        self.ip_connections = ip_connections
+        self.ip_rate = ip_rate
+        self.burst = max(THROTTLE_CHUNK, ip_rate / 4) if ip_rate else None
+
+    @contextmanager
+    def _state(self, ip):
+        path = os.path.join(self.path, quote(ip, safe=''))
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_nlink:
+                break
+            # Removed by its last transfer while we waited for the lock
+            os.close(fd)
+        try:
+            data = os.pread(fd, 65536, 0)
+            state = json.loads(data) if data else {'transfers': {}, 'tokens': self.burst, 'updated': time.monotonic()}
+            yield state
+            if state['transfers']:
+                data = json.dumps(state).encode()
+                os.pwrite(fd, data, 0)
+                os.ftruncate(fd, len(data))
+            else:
+                os.unlink(path)
+        finally:
+            os.close(fd)
+
+    def admit(self, ip):
+        """Count a transfer for ip in this process, or return False if ip is at its limit"""
+        pid = str(os.getpid())
+        with self._state(ip) as state:
+            transfers = {other: n for other, n in state['transfers'].items() if other == pid or pid_alive(int(other))}
+            state['transfers'] = transfers
+            if self.ip_connections and sum(transfers.values()) >= self.ip_connections:
+                return False
+            transfers[pid] = transfers.get(pid, 0) + 1
+            return True
+
+    def release(self, ip):
+        pid = str(os.getpid())
+        with self._state(ip) as state:
+            transfers = state['transfers']
+            transfers[pid] = transfers.get(pid, 1) - 1
+            if transfers[pid] <= 0:
+                del transfers[pid]
+
+    def reserve(self, ip, nbytes):
+        """TokenBucket.reserve on ip's shared bucket"""
+        with self._state(ip) as state:
+            now = time.monotonic()
+            tokens = min(self.burst, state['tokens'] + (now - state['updated']) * self.ip_rate) - nbytes
+            state.update(tokens=tokens, updated=now)
+            return max(0.0, -tokens / self.ip_rate)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Throttle:
+    """Admission control and byte-rate limits for downloads, shared by a process's threads.
+
+    With shared_dir the per-address limits are kept in a SharedClients there
+    instead, and hold across every process using the same directory.
+    """
+    def __init__(self, ip_connections=0, max_transfers=0, connection_rate=None, ip_rate=None, rate=None,
+                 shared_dir=None):
+        self.ip_connections = ip_connections
+        self.max_transfers = max_transfers
+        self.connection_rate = connection_rate
+        self.ip_rate = ip_rate
+        self.bucket = TokenBucket(rate) if rate else None
+        self.limits_rate = bool(connection_rate or ip_rate or rate)
+        self.transfers = 0
+        self.shared = SharedClients(shared_dir, ip_connections, ip_rate) if shared_dir else None
+        # Client address -> [active transfers, its token bucket or None], when not shared
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def admit(self, ip):
+        """Start a transfer for ip, or return the (status, message) to turn it away with"""
+        with self._lock:
+            if self.max_transfers and self.transfers >= self.max_transfers:
+                return 503, "Server busy, try again later"
+            if self.shared is None:
+                client = self._clients.get(ip)
+                if client is None:
+                    client = self._clients[ip] = [0, TokenBucket(self.ip_rate) if self.ip_rate else None]
+                elif self.ip_connections and client[0] >= self.ip_connections:
+                    return 429, "Too many concurrent downloads from your address"
+                client[0] += 1
+            self.transfers += 1
+        # File I/O, so outside the lock the other threads need for every download
+        if self.shared is not None and not self.shared.admit(ip):
+            with self._lock:
+                self.transfers -= 1
+            return 429, "Too many concurrent downloads from your address"
+        return None
+
+    def release(self, ip):
+        with self._lock:
+            self.transfers -= 1
+            if self.shared is None:
+                client = self._clients[ip]
+                client[0] -= 1
+                if not client[0]:
+                    del self._clients[ip]
+        if self.shared is not None:
+            self.shared.release(ip)
+
+    def limit(self, chunks, ip):
+        """Pace chunks to the per-transfer, per-address and global rates"""
+        if not self.limits_rate:
+            return chunks
+        if self.shared is not None:
+            ip_reserve = (lambda nbytes: self.shared.reserve(ip, nbytes)) if self.ip_rate else None
+        else:
+            ip_reserve = self._clients[ip][1].reserve if self.ip_rate else None
+        reserves = [reserve for reserve in (
+            TokenBucket(self.connection_rate).reserve if self.connection_rate else None,
+            ip_reserve,
+            self.bucket.reserve if self.bucket is not None else None,
+        ) if reserve is not None]
+
+        def generate():
+            for chunk in chunks:
+                delay = max(reserve(len(chunk)) for reserve in reserves)
+                if delay:
+                    time.sleep(delay)
+                yield chunk
+        return generate()
+
+throttle = Throttle(IP_CONNECTIONS, MAX_TRANSFERS, CONNECTION_RATE, IP_RATE, RATE)
+
+class CachedFile:
+    """Read-only file object over a cached memory map; stands in for the open file"""
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def seek(self, pos):
+        self.pos = pos
+
+    def read(self, n):
+        chunk = self.data[self.pos:self.pos + n]
+        self.pos += len(chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+class FileCache:
+    """Copies of hot files held in memory, evicted least recently used.
+
+    A file is copied in (by a background thread, so the request that earns
+    it a place is not delayed) once it has been asked for CACHE_ADMIT times
+    while uncached, which keeps one-off downloads from flushing popular
+    files out. Copies live in memfds where the OS has them: anonymous
+    memory with a descriptor, so each hit reopens its own read-only handle
+    through /proc and is still sent with sendfile. Elsewhere they are
+    anonymous memory maps read through Python. Either way a cached file
+    truncated on disk cannot SIGBUS the server, and memory goes back to the
+    OS once an evicted copy's last reader finishes.
+
+    Each hit checks the file's stat first, which also covers files reached
+    through symlinked folders that inotify never sees; inotify events from
+    the media index drop entries sooner still.
+    """
+    def __init__(self, budget, max_file):
+        self.budget = budget
+        self.max_file = max_file
+        self.used = 0
+        self.hits = self.misses = 0
+        self._entries = OrderedDict()
+        self._seen = OrderedDict()
+        self._loading = set()
+        # Loading paths that changed while being copied
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def open(self, path):
+        """Return (file, stat) for a cached, still current path, or None"""
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is not None:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is None or file_identity(st) != file_identity(entry[1]):
+                self.invalidate(path)
+        with self._lock:
+            # Looked up again under the lock: an evicted memfd's number may
+            # already belong to some other file
+            entry = self._entries.get(path)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(path)
+            copy, st = entry
+            if isinstance(copy, int):
+                return open(f"/proc/self/fd/{copy}", 'rb'), st
+        return CachedFile(copy), st
+
+    def offer(self, path, st):
+        """Note a request served from disk, and start caching the file once it is popular"""
+        if not 0 < st.st_size <= min(self.max_file, self.budget):
+            return
+        with self._lock:
+            seen = self._seen.pop(path, 0) + 1
+            if seen < CACHE_ADMIT or path in self._loading:
+                self._seen[path] = seen
+                if len(self._seen) > 16 * 1024:
+                    self._seen.popitem(last=False)
+                return
+            self._loading.add(path)
+        threading.Thread(target=self.load, args=(path, st), daemon=True).start()
+
+    def load(self, path, st):
+        copy = None
+        try:
+            with open(path, 'rb') as f:
+                if file_identity(os.fstat(f.fileno())) != file_identity(st):
+                    return
+                if hasattr(os, 'memfd_create'):
+                    copy = os.memfd_create(os.path.basename(path), os.MFD_CLOEXEC)
+                    copied = 0
+                    while copied < st.st_size:
+                        sent = os.sendfile(copy, f.fileno(), copied, st.st_size - copied)
+                        if not sent:
+                            break
+                        copied += sent
+                else:
+                    copy = mmap.mmap(-1, st.st_size)
+                    copied = f.readinto(copy)
+                # Written to in place while we copied: the copy may be torn
+                if copied != st.st_size or file_identity(os.fstat(f.fileno())) != file_identity(st):
+                    return
+            with self._lock:
+                if path in self._dirty:
+                    return
+                while self.used + st.st_size > self.budget and self._entries:
+                    self._drop(next(iter(self._entries)))
+                self._entries[path] = (copy, st)
+                self.used += st.st_size
+                copy = None
+        except OSError:
+            pass
+        finally:
+            if isinstance(copy, int):
+                os.close(copy)
+            with self._lock:
+                self._loading.discard(path)
+                self._dirty.discard(path)
+
+    def _drop(self, path):
+        copy, st = self._entries.pop(path)
+        self.used -= st.st_size
+        # Readers still streaming the copy hold their own handle or reference to it
+        if isinstance(copy, int):
+            os.close(copy)
+
+    def invalidate(self, path, tree=False):
+        """Drop path, or with tree everything below it, or with path None everything"""
+        with self._lock:
+            if path is None:
+                doomed = list(self._entries)
+            elif tree:
+                doomed = [key for key in self._entries if key.startswith(path + '/')]
+            else:
+                doomed = [path] if path in self._entries else []
+            for key in doomed:
+                self._drop(key)
+            if path is None:
+                self._dirty.update(self._loading)
+            else:
+                self._dirty.update(key for key in self._loading
+                                   if key == path or tree and key.startswith(path + '/'))
+
+file_cache = FileCache(CACHE_BYTES, CACHE_MAX_FILE) if CACHE_BYTES else None
+
+def file_identity(st):
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+class Metrics:
+    """Request, transfer and hot-file counters for one process.
+
+    The hot list is a Space-Saving sketch: at most HOT_FILES entries of
+    [bytes, overestimate, requests], where a new file takes over the
+    smallest entry's byte count. Any file that really sent more than
+    1/HOT_FILES of all bytes is guaranteed to be in it. The smallest entry
+    is found through a min-heap holding one (bytes, name) per entry, whose
+    byte counts are only brought up to date when they reach the top.
+    """
+    def __init__(self):
+        self.requests = {}
+        self.bytes_sent = 0
+        self.ttfb = [0] * (len(TTFB_BUCKETS) + 1) + [0.0]
+        self.duration = [0] * (len(DURATION_BUCKETS) + 1) + [0.0]
+        self.hot = {}
+        self._heap = []
+        self._lock = threading.Lock()
+        # Snapshot writes come from the flush loop and from scrapes
+        self._write_lock = threading.Lock()
+
+    def count(self, status):
+        with self._lock:
+            self.requests[str(status)] = self.requests.get(str(status), 0) + 1
+
+    def transfer(self, name, sent, ttfb, duration):
+        with self._lock:
+            self.bytes_sent += sent
+            self.ttfb[bisect.bisect_left(TTFB_BUCKETS, ttfb)] += 1
+            self.ttfb[-1] += ttfb
+            self.duration[bisect.bisect_left(DURATION_BUCKETS, duration)] += 1
+            self.duration[-1] += duration
+            entry = self.hot.get(name)
+            if entry is None:
+                floor = 0
+                if len(self.hot) >= HOT_FILES:
+                    floor, smallest = heapq.heappop(self._heap)
+                    while self.hot[smallest][0] != floor:
+                        heapq.heappush(self._heap, (self.hot[smallest][0], smallest))
+                        floor, smallest = heapq.heappop(self._heap)
+                    del self.hot[smallest]
+                entry = self.hot[name] = [floor, floor, 0]
+                heapq.heappush(self._heap, (floor, name))
+            entry[0] += sent
+            entry[2] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': dict(self.requests),
+                'bytes_sent': self.bytes_sent,
+                'active': throttle.transfers,
+                'ttfb': list(self.ttfb),
+                'duration': list(self.duration),
+                'hot': {name: list(entry) for name, entry in self.hot.items()},
+                'cache': [file_cache.hits, file_cache.misses, file_cache.used] if file_cache else [0, 0, 0],
+            }
+
+    def write_snapshot(self):
+        """Save this worker's snapshot to METRICS_DIR; a later write never holds older counts"""
+        path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+        with self._write_lock:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(path + '.tmp', path)
+
+    def write_snapshots(self):
+        """Keep this worker's snapshot in METRICS_DIR fresh for whichever worker is scraped"""
+        while True:
+            self.write_snapshot()
+            time.sleep(METRICS_FLUSH)
+
+metrics = Metrics() if METRICS else None
+
+def merged_snapshot():
+    """Every worker's latest snapshot in METRICS_DIR added up, this worker's saved afresh first.
+
+    Only saved snapshots are summed, this worker's included: were its live
+    counts added to the others' saved ones, a scrape answered by another
+    worker next could see this one's counts fall back to its last save.
+    """
+    if not METRICS_DIR:
+        return metrics.snapshot()
+    metrics.write_snapshot()
+    total = None
+    for entry in os.scandir(METRICS_DIR):
+        pid = entry.name.removesuffix('.json')
+        if not entry.name.endswith('.json'):
+            continue
+        try:
+            with open(entry.path) as f:
+                other = json.load(f)
+        except (OSError, ValueError):
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except OSError:
+            # A worker that has gone keeps its counters but has no transfers in flight
+            other['active'] = 0
+        if total is None:
+            total = other
+            continue
+        for status, n in other['requests'].items():
+            total['requests'][status] = total['requests'].get(status, 0) + n
+        total['bytes_sent'] += other['bytes_sent']
+        total['active'] += other['active']
+        for key in ('ttfb', 'duration', 'cache'):
+            total[key] = [a + b for a, b in zip(total[key], other[key])]
+        for name, (sent, error, requests) in other['hot'].items():
+            mine = total['hot'].setdefault(name, [0, 0, 0])
+            mine[0] += sent
+            mine[1] += error
+            mine[2] += requests
+    # Only if METRICS_DIR went away under us
+    return total if total is not None else metrics.snapshot()
+
+def label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def histogram_lines(name, buckets, values):
+    lines, cumulative = [], 0
+    for bound, n in zip(buckets + ['+Inf'], values):
+        cumulative += n
+        lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+    lines += [f"{name}_sum {values[-1]:.6f}", f"{name}_count {cumulative}"]
+    return lines
+
+def file_etag(st):
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+def quoted_string(value):
+    """value as an RFC 9110 quoted-string, with its backslashes and quotes escaped"""
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def content_disposition(filename):
+    name = os.path.basename(filename)
+    if name.isascii() and name.isprintable():
+        return f'attachment; filename={quoted_string(name)}'
+    # Non-ASCII names and control characters, which can't go in a header
+    # as they are, are percent-encoded in filename*; filename gets what's
+    # left for clients that don't read it
+    simple = ''.join(c for c in unicodedata.normalize('NFKD', name) if c.isascii() and c.isprintable())
+    return f"attachment; filename={quoted_string(simple)}; filename*=UTF-8''{quote(name, safe='')}"
+
+def is_not_modified(etag, mtime):
+    """Evaluate If-None-Match, or failing that If-Modified-Since (RFC 9110 13.2.2)"""
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return parse_etags(if_none_match).contains_weak(etag)
+    since = parse_date(request.headers.get('If-Modified-Since'))
+    return since is not None and int(mtime) <= since.timestamp()
+
+def requested_ranges(etag, mtime, size):
+    """Return the (start, end) byte ranges to send, end exclusive.
+
+    None means send the whole file: no Range header, a malformed one, too
+    many ranges, or an If-Range that no longer matches. An empty list means
+    none of the ranges overlap the file.
+    """
+    header = parse_range_header(request.headers.get('Range'))
+    if header is None or header.units != 'bytes' or len(header.ranges) > MAX_RANGES:
+        return None
+
+    header_value = request.headers.get('If-Range')
+    if header_value is not None and header_value.strip().startswith('W/'):
+        # If-Range needs a strong match (RFC 9110 13.1.5), which a weak tag never is
+        return None
+    if_range = parse_if_range_header(header_value)
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None and int(if_range.date.timestamp()) != int(mtime):
+        return None
+
+    ranges = []
+    for start, end in header.ranges:
+        if start < 0:
+            # A suffix range: the last -start bytes
+            start, end = max(0, size + start), size
+        else:
+            end = size if end is None else min(end, size)
+        if start < end:
+            ranges.append((start, end))
+    return ranges
+
+def read_range(f, start, end, chunk_size=CHUNK_SIZE):
+    f.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = f.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+class FileRange:
+    """Bytes [start, end) of an open file, for a wsgi.file_wrapper.
+
+    fileno() lets the server sendfile from start; read() stops at end, so
+    a server that can't sendfile and iterates the wrapper instead does not
+    read the rest of the file only to throw it away.
+    """
+    def __init__(self, f, start, end):
+        self.f = f
+        self.end = end
+        f.seek(start)
+
+    def fileno(self):
+        return self.f.fileno()
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        return self.f.seek(pos, whence)
+
+    def tell(self):
+        return self.f.tell()
+
+    def read(self, n=-1):
+        remaining = max(self.end - self.f.tell(), 0)
+        return self.f.read(remaining if n is None or n < 0 else min(n, remaining))
+
+    def close(self):
+        self.f.close()
+
+def file_body(f, start, end):
+    """Body for bytes [start, end) of an open regular file.
+
+    With a server-provided wsgi.file_wrapper the server is handed the range
+    as a FileRange and sends it, zero-copy where it can. Without one (e.g. the Flask dev server), with USE_SENDFILE off,
+    or under byte-rate limits, the bytes are read through Python a chunk at
+    a time.
+    """
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if throttle.limits_rate:
+        return read_range(f, start, end, THROTTLE_CHUNK)
+    if USE_SENDFILE and file_wrapper is not None and not isinstance(f, CachedFile):
+        return file_wrapper(FileRange(f, start, end), CHUNK_SIZE)
+    return read_range(f, start, end)
+
+def is_compressible(content_type):
+    return (content_type.startswith('text/') or content_type in COMPRESSIBLE_TYPES
+            or content_type.endswith(('+json', '+xml')))
+
+def choose_encoding(file_path, st):
+    """Negotiate Accept-Encoding for a compressible file.
+
+    Returns (encoding, sidecar path). Up-to-date .zst/.gz sidecars win over
+    compressing on the fly, which is only offered for whole-file requests
+    of at least COMPRESS_MIN_SIZE bytes. (None, None) means identity.
+    """
+    available = {}
+    for encoding, suffix in SIDECARS:
+        try:
+            sidecar_st = os.stat(file_path + suffix)
+        except OSError:
+            continue
+        if stat.S_ISREG(sidecar_st.st_mode) and sidecar_st.st_mtime_ns >= st.st_mtime_ns:
+            available[encoding] = file_path + suffix
+    if 'Range' not in request.headers and st.st_size >= COMPRESS_MIN_SIZE:
+        if zstandard is not None:
+            available.setdefault('zstd', None)
+        available.setdefault('gzip', None)
+    encoding = request.accept_encodings.best_match(list(available))
+    return encoding, available.get(encoding)
+
+def compress_chunks(chunks, encoding):
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def open_regular(path):
+    """Open path if it is a regular file, returning (file, stat) or None"""
+    if file_cache is not None:
+        cached = file_cache.open(path)
+        if cached is not None:
+            return cached
+    # Open first and stat the open file: one lookup, and no window for the
+    # file to change between the check and the read
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+    st = os.fstat(f.fileno())
+    if not stat.S_ISREG(st.st_mode):
+        f.close()
+        return None
+    if file_cache is not None:
+        file_cache.offer(path, st)
+    return f, st
+
+def transfer_response(f, body, status, headers, name):
+    """Respond with body from open file f, subject to the download limits and measured"""
+    ip = request.remote_addr
+    rejected = throttle.admit(ip)
+    if rejected is not None:
+        f.close()
+        status, message = rejected
+        return Response(message, status=status, headers={'Retry-After': str(RETRY_AFTER)},
+                        mimetype='text/plain')
+    started = g.started
+    # Bytes and first-byte time of a body that passes through Python
+    progress = [0, None]
+    sendfile = False
+    done = []
+
+    def finish():
+        if done:
+            return
+        done.append(True)
+        f.close()
+        throttle.release(ip)
+        if metrics is not None:
+            now = time.perf_counter()
+            if sendfile:
+                # The server sends it in one call: counted as sent in full,
+                # with the first byte going out as the view returns
+                progress[:] = int(headers['Content-Length']), handed_over
+            metrics.transfer(name, progress[0], (progress[1] or now) - started, now - started)
+
+    def counted(chunks):
+        for chunk in chunks:
+            if progress[1] is None:
+                progress[1] = time.perf_counter()
+            progress[0] += len(chunk)
+            yield chunk
+
+    # A passed-through body is handed to the server as is, so the server
+    # closing it is what ends the transfer; Response.close (used when the
+    # body is dropped, e.g. for HEAD) covers the rest
+    body = throttle.limit(body, ip)
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None and isinstance(body, file_wrapper):
+        # Still a file wrapper, so the server can sendfile it
+        sendfile = request.method != 'HEAD'
+        body.close = finish
+    else:
+        body = ClosingIterator(counted(body) if metrics is not None else body, finish)
+    response = Response(body, status=status, headers=headers, direct_passthrough=True)
+    response.call_on_close(finish)
+    handed_over = time.perf_counter()
+    return response
+
+def multipart_body(f, ranges, size, content_type, boundary):
+    """Build the multipart/byteranges parts, returning (generator, content length)"""
+    heads = [
+        (f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+         f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n").encode()
+        for start, end in ranges
+    ]
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    length = sum(len(head) + end - start for head, (start, end) in zip(heads, ranges))
+    length += 2 * (len(ranges) - 1) + len(tail)
+
+    def generate():
+        for k, (head, (start, end)) in enumerate(zip(heads, ranges)):
+            yield (b"\r\n" + head) if k else head
+            yield from read_range(f, start, end)
+        yield tail
+
+    return generate(), length
+
+IndexEntry = namedtuple('IndexEntry', 'size mtime_ns sha256 inode')
+
+if INotify is not None:
+    WATCH_FLAGS = (flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.ATTRIB | flags.DELETE
+                   | flags.MOVED_FROM | flags.MOVED_TO)
+
+class HashStore:
+    """Content hashes keyed by (st_dev, st_ino, size, mtime_ns), in an append-only file.
+
+    Every worker reads the file; only the process holding the flock on
+    <path>.lock hashes and appends. The library is read once however many
+    workers there are, and not again after a restart. If the hasher exits,
+    its lock goes with it and another process takes over.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hashes = {}
+        self.offset = 0
+        self.lock_file = None
+
+    def claim(self):
+        """Whether this process is (now) the one that hashes"""
+        if self.lock_file is None:
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                lock_file = open(self.path + '.lock', 'a')
+            except OSError:
+                return False
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self.lock_file = lock_file
+        return True
+
+    def refresh(self):
+        """Read what has been appended since the last call"""
+        try:
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < self.offset:
+                    self.offset = 0
+                f.seek(self.offset)
+                data = f.read()
+        except OSError:
+            return
+        # A line still being appended is left for next time
+        data = data[:data.rfind(b'\n') + 1]
+        self.offset += len(data)
+        for line in data.splitlines():
+            try:
+                dev, ino, size, mtime_ns, digest = json.loads(line)
+            except ValueError:
+                continue
+            self.hashes[dev, ino, size, mtime_ns] = digest
+
+    def get(self, key):
+        return self.hashes.get(key)
+
+    def add(self, key, digest):
+        self.hashes[key] = digest
+        try:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps([*key, digest]) + '\n')
+        except OSError:
+            pass
+
+class MediaIndex:
+    """Sorted in-memory listing of a directory tree, kept current with inotify.
+
+    Paths are relative to root with '/' separators, the same names that
+    /download/ takes. Readers take the lock only long enough to slice the
+    sorted name list, so a listing never walks the filesystem.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.names = []
+        self.pending = queue.Queue()
+        self.hashes = None
+        self.inotify = None
+        self.watches = {}
+        self.rescanning = False
+        # Called with (path, whether it is a directory) for each change seen
+        # through inotify, and with (None, False) when events were lost
+        self.listeners = []
+
+    def start(self):
+        if INotify is not None:
+            self.inotify = INotify()
+        if INDEX_HASH:
+            self.hashes = HashStore(HASH_STORE)
+            self.hashes.refresh()
+        self.rebuild()
+        if self.inotify:
+            threading.Thread(target=self.watch, daemon=True).start()
+        else:
+            self.start_rescan()
+        if INDEX_HASH:
+            threading.Thread(target=self.hash_files, daemon=True).start()
+        return self
+
+    def start_rescan(self):
+        if not self.rescanning:
+            self.rescanning = True
+            threading.Thread(target=self.rescan, daemon=True).start()
+
+    def walk(self, rel_dir):
+        """Yield (relative path, stat) for regular files under rel_dir, watching each directory"""
+        path = os.path.join(self.root, rel_dir)
+        if self.inotify:
+            try:
+                self.watches[self.inotify.add_watch(path, WATCH_FLAGS)] = rel_dir
+            except OSError as e:
+                # Typically ENOSPC once fs.inotify.max_user_watches runs out. The
+                # files are indexed all the same, and periodic rebuilds keep them current
+                if not self.rescanning:
+                    print(f"Cannot watch {path} ({e}); rescanning the index every {INDEX_RESCAN}s")
+                    self.start_rescan()
+        try:
+            with os.scandir(path) as it:
+                children = list(it)
+        except OSError:
+            return
+        for child in children:
+            rel = f"{rel_dir}/{child.name}" if rel_dir else child.name
+            try:
+                if child.is_dir(follow_symlinks=False):
+                    yield from self.walk(rel)
+                elif child.is_file():
+                    yield rel, child.stat()
+            except OSError:
+                continue
+
+    def rebuild(self):
+        """Replace the whole index from a fresh walk, keeping hashes of unchanged files"""
+        entries = {}
+        for rel, st in self.walk(''):
+            entries[rel] = self.make_entry(rel, st)
+        with self.lock:
+            self.entries = entries
+            self.names = sorted(entries)
+
+    def make_entry(self, rel, st):
+        inode = (st.st_dev, st.st_ino)
+        old = self.entries.get(rel)
+        if old is not None and (old.size, old.mtime_ns, old.inode) == (st.st_size, st.st_mtime_ns, inode):
+            return old
+        digest = None
+        if self.hashes is not None:
+            digest = self.hashes.get((*inode, st.st_size, st.st_mtime_ns))
+            if digest is None:
+                self.pending.put(rel)
+        return IndexEntry(st.st_size, st.st_mtime_ns, digest, inode)
+
+    def update(self, rel):
+        try:
+            st = os.stat(os.path.join(self.root, rel))
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            self.remove(rel)
+            return
+        entry = self.make_entry(rel, st)
+        with self.lock:
+            if rel not in self.entries:
+                bisect.insort(self.names, rel)
+            self.entries[rel] = entry
+
+    def add_tree(self, rel_dir):
+        for rel, st in self.walk(rel_dir):
+            entry = self.make_entry(rel, st)
+            with self.lock:
+                if rel not in self.entries:
+                    bisect.insort(self.names, rel)
+                self.entries[rel] = entry
+
+    def remove(self, rel):
+        with self.lock:
+            if self.entries.pop(rel, None) is not None:
+                del self.names[bisect.bisect_left(self.names, rel)]
+
+    def remove_tree(self, rel_dir):
+        prefix = rel_dir + '/'
+        for wd, watched in list(self.watches.items()):
+            if watched == rel_dir or watched.startswith(prefix):
+                # A directory moved out of the tree keeps its watch; drop it
+                del self.watches[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass
+        with self.lock:
+            start = bisect.bisect_left(self.names, prefix)
+            end = bisect.bisect_left(self.names, prefix + '\U0010ffff')
+            for rel in self.names[start:end]:
+                del self.entries[rel]
+            del self.names[start:end]
+
+    def watch(self):
+        while True:
+            for event in self.inotify.read():
+                if event.mask & flags.Q_OVERFLOW:
+                    # Events were lost; only a full walk can resynchronise
+                    self.rebuild()
+                    for listener in self.listeners:
+                        listener(None, False)
+                    continue
+                if event.mask & flags.IGNORED:
+                    self.watches.pop(event.wd, None)
+                    continue
+                rel_dir = self.watches.get(event.wd)
+                if rel_dir is None or not event.name:
+                    continue
+                rel = f"{rel_dir}/{event.name}" if rel_dir else event.name
+                for listener in self.listeners:
+                    listener(os.path.join(self.root, rel), bool(event.mask & flags.ISDIR))
+                if event.mask == flags.MODIFY:
+                    # Mid-write: the index catches up at CLOSE_WRITE rather than restat
+                    # (and rehash) a file that is still growing
+                    continue
+                if event.mask & flags.ISDIR:
+                    if event.mask & (flags.DELETE | flags.MOVED_FROM):
+                        self.remove_tree(rel)
+                    elif event.mask & (flags.CREATE | flags.MOVED_TO):
+                        self.add_tree(rel)
+                elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                    self.remove(rel)
+                else:
+                    self.update(rel)
+
+    def rescan(self):
+        while True:
+            time.sleep(INDEX_RESCAN)
+            self.rebuild()
+
+    def hash_files(self):
+        waiting = set()
+        while True:
+            try:
+                waiting.add(self.pending.get(timeout=HASH_POLL))
+                while True:
+                    waiting.add(self.pending.get_nowait())
+            except queue.Empty:
+                pass
+            self.hashes.refresh()
+            hasher = self.hashes.claim()
+            for rel in list(waiting):
+                with self.lock:
+                    entry = self.entries.get(rel)
+                if entry is None or entry.sha256 is not None:
+                    waiting.discard(rel)
+                    continue
+                key = (*entry.inode, entry.size, entry.mtime_ns)
+                digest = self.hashes.get(key)
+                if digest is None:
+                    if not hasher:
+                        # Left for the hashing process; its result turns up in a later refresh
+                        continue
+                    digest = self.hash_file(rel, entry)
+                    if digest is None:
+                        # Gone or changed since: a newer entry gets queued for it
+                        waiting.discard(rel)
+                        continue
+                    self.hashes.add(key, digest)
+                waiting.discard(rel)
+                with self.lock:
+                    if self.entries.get(rel) == entry:
+                        self.entries[rel] = entry._replace(sha256=digest)
+
+    def hash_file(self, rel, entry):
+        digest = hashlib.sha256()
+        try:
+            with open(os.path.join(self.root, rel), 'rb') as f:
+                while chunk := f.read(1024 * 1024):
+                    digest.update(chunk)
+                st = os.fstat(f.fileno())
+        except OSError:
+            return None
+        # Only trust the hash if the file did not change underneath us
+        if (st.st_size, st.st_mtime_ns, (st.st_dev, st.st_ino)) != (entry.size, entry.mtime_ns, entry.inode):
+            return None
+        return digest.hexdigest()
+
+    def page(self, prefix='', after=None, limit=LIST_LIMIT):
+        """Return up to limit (name, entry) pairs that start with prefix and sort after after,
+        the number of names matching prefix, and whether more follow this page
+        """
+        with self.lock:
+            start = bisect.bisect_left(self.names, prefix)
+            end = bisect.bisect_left(self.names, prefix + '\U0010ffff')
+            first = max(start, bisect.bisect_right(self.names, after)) if after else start
+            names = self.names[first:min(first + limit, end)]
+            return [(name, self.entries[name]) for name in names], end - start, first + limit < end
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def count_response(response):
+    if metrics is not None:
+        metrics.count(response.status_code)
+    return response
+
+@app.route('/metrics')
+def metrics_text():
+    """Prometheus text exposition of the download metrics, summed over all workers"""
+    if metrics is None:
+        abort(404)
+    snapshot = merged_snapshot()
+    lines = [
+        "# HELP my_http_requests_total HTTP responses by status code.",
+        "# TYPE my_http_requests_total counter",
+    ]
+    lines += [f'my_http_requests_total{{status="{status}"}} {n}'
+              for status, n in sorted(snapshot['requests'].items())]
+    lines += [
+        "# HELP my_sent_bytes_total Body bytes sent by downloads.",
+        "# TYPE my_sent_bytes_total counter",
+        f"my_sent_bytes_total {snapshot['bytes_sent']}",
+        "# HELP my_active_transfers Downloads in progress.",
+        "# TYPE my_active_transfers gauge",
+        f"my_active_transfers {snapshot['active']}",
+        "# HELP my_ttfb_seconds Time from request to first body byte of a download.",
+        "# TYPE my_ttfb_seconds histogram",
+    ]
+    lines += histogram_lines('my_ttfb_seconds', TTFB_BUCKETS, snapshot['ttfb'])
+    lines += [
+        "# HELP my_transfer_duration_seconds Time from request to the end of a download.",
+        "# TYPE my_transfer_duration_seconds histogram",
+    ]
+    lines += histogram_lines('my_transfer_duration_seconds', DURATION_BUCKETS, snapshot['duration'])
+    hot = sorted(snapshot['hot'].items(), key=lambda item: item[1][0], reverse=True)[:HOT_FILES_SHOWN]
+    lines += [
+        "# HELP my_hot_file_sent_bytes Bytes sent for the most downloaded files (may overcount by the error).",
+        "# TYPE my_hot_file_sent_bytes gauge",
+    ]
+    lines += [f'my_hot_file_sent_bytes{{file="{label(name)}"}} {sent}' for name, (sent, _, _) in hot]
+    lines += [
+        "# HELP my_hot_file_sent_bytes_error Upper bound on the overcount in my_hot_file_sent_bytes.",
+        "# TYPE my_hot_file_sent_bytes_error gauge",
+    ]
+    lines += [f'my_hot_file_sent_bytes_error{{file="{label(name)}"}} {error}' for name, (_, error, _) in hot]
+    lines += [
+        "# HELP my_hot_file_requests Downloads of the most downloaded files since they entered the hot list.",
+        "# TYPE my_hot_file_requests gauge",
+    ]
+    lines += [f'my_hot_file_requests{{file="{label(name)}"}} {requests}' for name, (_, _, requests) in hot]
+    if file_cache is not None:
+        hits, misses, used = snapshot['cache']
+        lines += [
+            "# HELP my_cache_hits_total Downloads served from the hot-file cache.",
+            "# TYPE my_cache_hits_total counter",
+            f"my_cache_hits_total {hits}",
+            "# HELP my_cache_misses_total Cache lookups that went to disk.",
+            "# TYPE my_cache_misses_total counter",
+            f"my_cache_misses_total {misses}",
+            "# HELP my_cache_bytes Bytes of files held in the hot-file cache.",
+            "# TYPE my_cache_bytes gauge",
+            f"my_cache_bytes {used}",
+        ]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+_media_index = None
+_media_index_lock = threading.Lock()
+
+def media_index():
+    """The index for this process, built on first use (and again in each forked worker)"""
+    global _media_index
+    with _media_index_lock:
+        if _media_index is None or _media_index.pid != os.getpid():
+            _media_index = MediaIndex(MEDIA_FOLDER)
+            if file_cache is not None:
+                _media_index.listeners.append(file_cache.invalidate)
+            _media_index.start()
+        return _media_index
+
+@app.route('/list')
+@app.route('/list/<path:prefix>')
+def list_files(prefix=''):
+    """JSON listing of MEDIA_FOLDER in name order.
+
+    The path (or ?prefix=) restricts it to names starting with a prefix;
+    ?limit= sets the page size and ?after= continues from the previous
+    page's "next" value.
+    """
+    prefix = request.args.get('prefix', prefix)
+    after = request.args.get('after')
+    try:
+        limit = int(request.args.get('limit', LIST_LIMIT))
+    except ValueError:
+        abort(400)
+    if not 0 < limit <= MAX_LIST_LIMIT:
+        abort(400)
+
+    page, total, more = media_index().page(prefix, after, limit)
+    files = [
+        {'name': name, 'size': entry.size, 'mtime': entry.mtime_ns / 1e9, 'sha256': entry.sha256}
+        for name, entry in page
+    ]
+    return jsonify(files=files, total=total, next=page[-1][0] if more else None)
 
 @app.route('/download/<path:filename>')
 def download_file(filename):
-    file_path = os.path.join(MEDIA_FOLDER, filename)
-    if os.path.isfile(file_path):
-        return send_from_directory(MEDIA_FOLDER, filename, as_attachment=True)
-    else:
+    file_path = safe_join(MEDIA_FOLDER, filename)
+    if file_path is None:
         abort(404)
+    opened = open_regular(file_path)
+    if opened is None:
+        abort(404)
+    f, st = opened
+
+    content_type, file_encoding = mimetypes.guess_type(file_path)
+    content_type = content_type or 'application/octet-stream'
+    encoding = sidecar = None
+    headers = {}
+    if file_encoding is None and is_compressible(content_type):
+        headers['Vary'] = 'Accept-Encoding'
+        encoding, sidecar = choose_encoding(file_path, st)
+        if sidecar is not None:
+            # The precompressed file is served as is, ranges included
+            opened = open_regular(sidecar)
+            if opened is None:
+                encoding = None
+            else:
+                f.close()
+                f, st = opened
+
+    size = st.st_size
+    etag = file_etag(st)
+    if encoding is not None:
+        etag += '-' + encoding
+        headers['Content-Encoding'] = encoding
+    headers.update({
+        'ETag': quote_etag(etag),
+        'Last-Modified': http_date(st.st_mtime),
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': content_disposition(filename),
+    })
+
+    if is_not_modified(etag, st.st_mtime):
+        f.close()
+        return Response(status=304, headers=headers)
+
+    if encoding is not None and sidecar is None:
+        # Compressed on the fly: length unknown up front, so the body is chunked
+        headers['Content-Type'] = content_type
+        return transfer_response(f, compress_chunks(read_range(f, 0, size), encoding), 200, headers, filename)
+
+    ranges = requested_ranges(etag, st.st_mtime, size)
+    if ranges is None:
+        body, status, length = file_body(f, 0, size), 200, size
+        headers['Content-Type'] = content_type
+    elif not ranges:
+        f.close()
+        headers['Content-Range'] = f"bytes */{size}"
+        return Response(status=416, headers=headers)
+    elif len(ranges) == 1:
+        (start, end), = ranges
+        body, status, length = file_body(f, start, end), 206, end - start
+        headers['Content-Type'] = content_type
+        headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+    else:
+        boundary = uuid.uuid4().hex
+        body, length = multipart_body(f, ranges, size, content_type, boundary)
+        status = 206
+        headers['Content-Type'] = f"multipart/byteranges; boundary={boundary}"
+
+    headers['Content-Length'] = str(length)
+    return transfer_response(f, body, status, headers, filename)
+
+if BaseApplication is not None:
+    class MediaServer(BaseApplication):
+        """Run app under gunicorn with options from the serve command"""
+
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+def close_idle_on_term(worker):
+    """Make SIGTERM also hang up this worker's idle keep-alive connections.
+
+    gthread only expires idle connections between polls, and while draining
+    it polls for the whole graceful timeout, so a browser holding a
+    connection open would keep the worker (and a deploy) waiting that long.
+    Shutting the sockets down wakes the poll; gthread then reads EOF and
+    closes them, leaving only the transfers in flight to drain.
+    """
+    handle_exit = worker.handle_exit
+
+    def on_term(sig, frame):
+        handle_exit(sig, frame)
+        for conn in list(getattr(worker, 'keepalived_conns', ())):
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, on_term)
+
+def start_worker(worker):
+    close_idle_on_term(worker)
+    media_index()
+    if metrics is not None and METRICS_DIR:
+        threading.Thread(target=metrics.write_snapshots, daemon=True).start()
+
+def serve(args):
+    if BaseApplication is None:
+        print("The serve command needs gunicorn: pip install gunicorn")
+        raise SystemExit(1)
+    global USE_SENDFILE, METRICS_DIR, throttle, file_cache
+    if args.cache_bytes:
+        file_cache = FileCache(args.cache_bytes, args.cache_max_file)
+    own_metrics_dir = metrics is not None and args.workers > 1 and not METRICS_DIR
+    if own_metrics_dir:
+        METRICS_DIR = tempfile.mkdtemp(prefix='my-metrics-')
+    USE_SENDFILE = USE_SENDFILE and not args.no_sendfile
+    # Each worker keeps its own counters, so the overall cap is shared out between them
+    rate = args.rate / args.workers if args.rate else None
+    # A client's downloads land on any worker, so its limits are kept where all of them can see
+    shared_dir = None
+    if args.workers > 1 and (args.ip_connections or args.ip_rate):
+        shared_dir = tempfile.mkdtemp(prefix='my-clients-')
+    throttle = Throttle(args.ip_connections, args.max_transfers, args.connection_rate, args.ip_rate, rate,
+                        shared_dir)
+    options = {
+        'bind': args.bind,
+        'workers': args.workers,
+        # Threaded workers: each download holds a thread, mostly parked in sendfile
+        'worker_class': 'gthread',
+        'threads': args.threads,
+        # Per-worker cap on open connections, idle keep-alive ones included
+        'worker_connections': args.max_connections,
+        'backlog': args.backlog,
+        'keepalive': args.keepalive,
+        # SIGTERM stops accepting and gives in-flight downloads this long to finish
+        'graceful_timeout': args.graceful_timeout,
+        'timeout': args.timeout,
+        'sendfile': USE_SENDFILE,
+        'accesslog': '-' if args.access_log else None,
+        # Build the listing index as each worker starts, not on its first request
+        'post_worker_init': start_worker,
+    }
+    own_dirs = ([METRICS_DIR] if own_metrics_dir else []) + ([shared_dir] if shared_dir else [])
+    if own_dirs:
+        options['on_exit'] = lambda server: [shutil.rmtree(path, ignore_errors=True) for path in own_dirs]
+    MediaServer(app, options).run()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
+    parser = argparse.ArgumentParser(description="Serve files from MEDIA_FOLDER over HTTP")
+    subparsers = parser.add_subparsers(dest='command')
+    serve_parser = subparsers.add_parser('serve', help="Run under gunicorn with multiple workers and threads")
+    serve_parser.add_argument('--bind', default='0.0.0.0:8080', help="Address to listen on (default: 0.0.0.0:8080)")
+    serve_parser.add_argument('--workers', type=int, default=min(os.cpu_count() or 1, 8),
+                              help="Worker processes (default: CPU count, at most 8)")
+    serve_parser.add_argument('--threads', type=int, default=32, help="Threads per worker (default: 32)")
+    serve_parser.add_argument('--max-connections', type=int, default=256,
+                              help="Open connections per worker, keep-alive included (default: 256)")
+    serve_parser.add_argument('--backlog', type=int, default=2048, help="Listen queue length (default: 2048)")
+    serve_parser.add_argument('--keepalive', type=int, default=5,
+                              help="Seconds to hold an idle keep-alive connection (default: 5)")
+    serve_parser.add_argument('--graceful-timeout', type=int, default=60,
+                              help="Seconds to drain in-flight downloads after SIGTERM (default: 60)")
+    serve_parser.add_argument('--timeout', type=int, default=60,
+                              help="Restart a worker silent for this many seconds (default: 60)")
+    serve_parser.add_argument('--no-sendfile', action='store_true', help="Send file bodies through Python")
+    serve_parser.add_argument('--cache-bytes', type=parse_size, default=CACHE_BYTES,
+                              help="Memory per worker for caching hot files, e.g. 512M (default: off)")
+    serve_parser.add_argument('--cache-max-file', type=parse_size, default=CACHE_MAX_FILE,
+                              help="Largest file the cache takes (default: 64M)")
+    serve_parser.add_argument('--ip-connections', type=int, default=IP_CONNECTIONS,
+                              help="Concurrent downloads per client address before 429 (default: no cap)")
+    serve_parser.add_argument('--max-transfers', type=int, default=MAX_TRANSFERS,
+                              help="Concurrent downloads before 503, per worker (default: no cap)")
+    serve_parser.add_argument('--connection-rate', type=parse_rate, default=CONNECTION_RATE,
+                              help="Bytes/sec per download, e.g. 2M (default: unlimited)")
+    serve_parser.add_argument('--ip-rate', type=parse_rate, default=IP_RATE,
+                              help="Bytes/sec per client address (default: unlimited)")
+    serve_parser.add_argument('--rate', type=parse_rate, default=RATE,
+                              help="Total egress bytes/sec, split across workers (default: unlimited)")
+    serve_parser.add_argument('--access-log', action='store_true', help="Log each request to stdout")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args)
+    else:
+        # The single-process Flask development server
+        media_index()
+        app.run(host='0.0.0.0', port=8080)
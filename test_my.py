@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Range and conditional request tests for my.py's /download, on a sparse file past 4 GiB"""
+import itertools
+import os
+import tempfile
+import unittest
+
+MEDIA = tempfile.mkdtemp(prefix='my-test-')
+os.environ['MEDIA_FOLDER'] = MEDIA
+
+import my
+from werkzeug.http import parse_options_header
+from werkzeug.wsgi import FileWrapper
+
+SIZE = 5 * 1024 ** 3
+# Offsets past 2**32, where 32-bit arithmetic anywhere on the path would wrap
+HIGH = 4 * 1024 ** 3 + 4096
+HEAD_MARK = b'head-of-the-file'
+HIGH_MARK = b'past-four-gibibytes'
+TAIL_MARK = b'end-of-the-file!'
+
+
+def setUpModule():
+    # Sparse: only the marked blocks take disk space
+    with open(os.path.join(MEDIA, 'big.bin'), 'wb') as f:
+        f.truncate(SIZE)
+        f.write(HEAD_MARK)
+        f.seek(HIGH)
+        f.write(HIGH_MARK)
+        f.seek(SIZE - len(TAIL_MARK))
+        f.write(TAIL_MARK)
+
+
+def tearDownModule():
+    os.remove(os.path.join(MEDIA, 'big.bin'))
+    os.rmdir(MEDIA)
+
+
+class DownloadRangeTest(unittest.TestCase):
+    url = '/download/big.bin'
+
+    def setUp(self):
+        self.client = my.app.test_client()
+
+    def get(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        # Full 5 GiB bodies are never read; closing releases the file and throttle slot
+        self.addCleanup(response.close)
+        return response
+
+    def validators(self):
+        response = self.get()
+        return response.headers['ETag'], response.headers['Last-Modified']
+
+    def test_full_file(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(response.headers['Content-Length']), SIZE)
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+
+    def test_single_range_past_4gib(self):
+        end = HIGH + len(HIGH_MARK) - 1
+        response = self.get(Range=f'bytes={HIGH}-{end}')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'], f'bytes {HIGH}-{end}/{SIZE}')
+        self.assertEqual(int(response.headers['Content-Length']), len(HIGH_MARK))
+        self.assertEqual(response.get_data(), HIGH_MARK)
+
+    def test_open_ended_range_clamped(self):
+        start = SIZE - len(TAIL_MARK)
+        response = self.get(Range=f'bytes={start}-{SIZE * 2}')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'], f'bytes {start}-{SIZE - 1}/{SIZE}')
+        self.assertEqual(response.get_data(), TAIL_MARK)
+
+    def test_suffix_range(self):
+        response = self.get(Range=f'bytes=-{len(TAIL_MARK)}')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers['Content-Range'],
+                         f'bytes {SIZE - len(TAIL_MARK)}-{SIZE - 1}/{SIZE}')
+        self.assertEqual(response.get_data(), TAIL_MARK)
+
+    def test_multiple_ranges(self):
+        high_end = HIGH + len(HIGH_MARK) - 1
+        response = self.get(Range=f'bytes=0-{len(HEAD_MARK) - 1},{HIGH}-{high_end},-{len(TAIL_MARK)}')
+        self.assertEqual(response.status_code, 206)
+        content_type = response.headers['Content-Type']
+        self.assertTrue(content_type.startswith('multipart/byteranges; boundary='))
+        boundary = content_type.split('boundary=')[1]
+        body = response.get_data()
+        self.assertEqual(int(response.headers['Content-Length']), len(body))
+
+        parts = body.split(f'--{boundary}'.encode())
+        self.assertEqual(parts[0], b'')
+        self.assertEqual(parts[-1], b'--\r\n')
+        expected = [(0, HEAD_MARK), (HIGH, HIGH_MARK), (SIZE - len(TAIL_MARK), TAIL_MARK)]
+        self.assertEqual(len(parts[1:-1]), len(expected))
+        for part, (start, mark) in zip(parts[1:-1], expected):
+            head, data = part.split(b'\r\n\r\n', 1)
+            self.assertIn(f'Content-Range: bytes {start}-{start + len(mark) - 1}/{SIZE}'.encode(), head)
+            self.assertEqual(data, mark + b'\r\n')
+
+    def test_single_range_through_file_wrapper(self):
+        # A server that can't sendfile iterates the wrapper: it must stop at the range's end
+        end = HIGH + len(HIGH_MARK) - 1
+        response = self.client.get(self.url, headers={'Range': f'bytes={HIGH}-{end}'},
+                                   environ_overrides={'wsgi.file_wrapper': FileWrapper})
+        self.addCleanup(response.close)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(itertools.islice(response.response, 4)), HIGH_MARK)
+
+    def test_unsatisfiable_range(self):
+        response = self.get(Range=f'bytes={SIZE}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response.headers['Content-Range'], f'bytes */{SIZE}')
+
+    def test_not_modified_by_etag(self):
+        etag, _ = self.validators()
+        response = self.get(**{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+    def test_not_modified_by_date(self):
+        _, last_modified = self.validators()
+        response = self.get(**{'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+    def test_if_range_matching(self):
+        etag, last_modified = self.validators()
+        for validator in (etag, last_modified):
+            response = self.get(Range='bytes=0-3', **{'If-Range': validator})
+            self.assertEqual(response.status_code, 206, validator)
+            self.assertEqual(response.get_data(), HEAD_MARK[:4])
+
+    def test_if_range_stale(self):
+        for validator in ('"stale-etag"', 'Thu, 01 Jan 2015 00:00:00 GMT'):
+            response = self.get(Range='bytes=0-3', **{'If-Range': validator})
+            self.assertEqual(response.status_code, 200, validator)
+            self.assertEqual(int(response.headers['Content-Length']), SIZE)
+
+    def test_if_range_weak_etag_sends_whole_file(self):
+        etag, _ = self.validators()
+        response = self.get(Range='bytes=0-3', **{'If-Range': f'W/{etag}'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(response.headers['Content-Length']), SIZE)
+
+
+class ContentDispositionTest(unittest.TestCase):
+    def test_quotes_and_backslashes_escaped(self):
+        name = 'a"b;c\\d.mkv'
+        path = os.path.join(MEDIA, name)
+        with open(path, 'wb') as f:
+            f.write(HEAD_MARK)
+        self.addCleanup(os.remove, path)
+        with my.app.test_client() as client:
+            response = client.get('/download/' + name)
+            response.close()
+        self.assertEqual(response.status_code, 200)
+        disposition, options = parse_options_header(response.headers['Content-Disposition'])
+        self.assertEqual(disposition, 'attachment')
+        self.assertEqual(options, {'filename': name})
+
+
+if __name__ == '__main__':
+    unittest.main()